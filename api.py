@@ -1,10 +1,48 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
 import aiohttp
-from ppretty import ppretty
 
+import esr_encoder
+from metrics import ESR_SECONDS
+from resilience import ResilientCall, CircuitBreaker, CircuitOpenError
 
-async def api_get(account, memo=''):
+log = logging.getLogger("api")
+
+ESR_URL = os.getenv("ESR_URL", 'https://api-esr.hypha.earth/qr')
+ESR_CONN_LIMIT = int(os.getenv("ESR_CONN_LIMIT", 20))
+ESR_KEEPALIVE = float(os.getenv("ESR_KEEPALIVE", 30))
+ESR_TIMEOUT = float(os.getenv("ESR_TIMEOUT", 10))
+ESR_CONNECT_TIMEOUT = float(os.getenv("ESR_CONNECT_TIMEOUT", 3))
+# "remote" asks the Hypha service, "local" encodes the request in-process (needs
+# qrcode to render the QR image) and falls back to remote on failure. Stays opt-in
+# until tests/fixtures/esr_remote.json holds recorded Hypha output to compare with.
+ESR_ENCODER = os.getenv("ESR_ENCODER", "remote")
+# Resilience of the remote call, see resilience.ResilientCall
+ESR_ATTEMPTS = int(os.getenv("ESR_ATTEMPTS", 3))
+ESR_ATTEMPT_TIMEOUT = float(os.getenv("ESR_ATTEMPT_TIMEOUT", 4))
+ESR_DEADLINE = float(os.getenv("ESR_DEADLINE", ESR_TIMEOUT))
+ESR_HEDGE_PERCENTILE = float(os.getenv("ESR_HEDGE_PERCENTILE", 0.95))
+ESR_BREAKER_THRESHOLD = int(os.getenv("ESR_BREAKER_THRESHOLD", 5))
+ESR_BREAKER_RESET = float(os.getenv("ESR_BREAKER_RESET", 30))
+
+
+class EsrError(Exception):
+    """The ESR service answered something that is not a signing request"""
+
+
+class EsrUnavailable(Exception):
+    """No signing request could be produced, the user should try again later"""
+
+
+def build_acknowledge(account, memo=''):
+    """One acknowledge action per account, account may be a single name or a list"""
     memo = memo if memo else ''
-    json = {
+    accounts = [account] if isinstance(account, str) else account
+    return {
         "actions": [
             {
                 "account": "gratz.seeds",
@@ -17,19 +55,101 @@ async def api_get(account, memo=''):
                 ],
                 "data": {
                     "from": "............1",
-                    "to": account,
+                    "to": to,
                     "memo": memo
                 }
             }
+            for to in accounts
         ]
     }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post('https://api-esr.hypha.earth/qr',
-                                json=json) as response:
-            print("Status:", response.status)
-            print("Content-type:", response.headers['content-type'])
 
-            json = await response.json()
-            print("Body:", ppretty(json))
-            return json
+class EsrClient:
+    """
+    Long-lived client for the Hypha ESR endpoint.
+
+    Owns a single ClientSession with a keep-alive connector, so every /gratz
+    reuses the same TCP+TLS connection instead of doing a new handshake.
+    """
+
+    def __init__(self, url=ESR_URL, limit=ESR_CONN_LIMIT, keepalive_timeout=ESR_KEEPALIVE,
+                 timeout=ESR_TIMEOUT, connect_timeout=ESR_CONNECT_TIMEOUT, encoder=ESR_ENCODER):
+        self.url = url
+        self.local = encoder == "local"
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.resilience = ResilientCall(attempts=ESR_ATTEMPTS,
+                                        attempt_timeout=ESR_ATTEMPT_TIMEOUT,
+                                        deadline=ESR_DEADLINE,
+                                        hedge_percentile=ESR_HEDGE_PERCENTILE,
+                                        breaker=CircuitBreaker(ESR_BREAKER_THRESHOLD, ESR_BREAKER_RESET),
+                                        retry_on=(aiohttp.ClientError, EsrError))
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit,
+                                             limit_per_host=self.limit,
+                                             keepalive_timeout=self.keepalive_timeout,
+                                             ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("EsrClient is not started, call start() first")
+        return self._session
+
+    async def get_qr(self, account, memo=''):
+        request = build_acknowledge(account, memo)
+        if self.local:
+            started = time.perf_counter()
+            try:
+                qr = esr_encoder.encode_request(request)
+                ESR_SECONDS.observe(time.perf_counter() - started, encoder="local", result="ok")
+                return qr
+            except Exception as e:
+                ESR_SECONDS.observe(time.perf_counter() - started, encoder="local", result="error")
+                log.warning("Local ESR encoder failed, using %s => Error %s", self.url, e)
+        try:
+            return await self.resilience.call(lambda: self.get_remote_qr(request))
+        except (CircuitOpenError, EsrError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise EsrUnavailable(repr(e)) from e
+
+    async def get_remote_qr(self, request):
+        with ESR_SECONDS.time(encoder="remote", result="error") as labels:
+            body = await self._post_request(request)
+            labels["result"] = "ok"
+            return body
+
+    async def _post_request(self, request):
+        account = ",".join(action["data"]["to"] for action in request["actions"])
+        async with self.session.post(self.url, json=request) as response:
+            response.raise_for_status()
+            try:
+                body = await response.json(content_type=None)
+            except ValueError as e:
+                raise EsrError(f"Invalid JSON from {self.url}: {e}")
+            if not isinstance(body, dict) or not body.get("esr"):
+                raise EsrError(f"No esr in response from {self.url}")
+            log.info("esr status=%s account=%s esr_len=%s", response.status, account, len(body["esr"]))
+            return body
+
+    def stats(self):
+        return dict(self.resilience.stats(), encoder="local" if self.local else "remote")
+
+
+async def api_get(account, memo=''):
+    """One-shot helper kept for scripts; the bot uses a shared EsrClient."""
+    client = await EsrClient().start()
+    try:
+        return await client.get_qr(account, memo)
+    finally:
+        await client.close()
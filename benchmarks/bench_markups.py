@@ -0,0 +1,38 @@
+"""
+Preparing reply_markup for a request: building + serializing each time vs markups.MARKUPS
+
+    python benchmarks/bench_markups.py [iterations]
+"""
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiogram.types import ReplyKeyboardRemove  # noqa: E402
+from aiogram.utils.payload import prepare_arg  # noqa: E402
+
+from markups import LANGUAGE_KEYBOARD, REMOVE_KEYBOARD, build_language_keyboard  # noqa: E402
+
+
+def per_request():
+    return prepare_arg(build_language_keyboard()), prepare_arg(ReplyKeyboardRemove())
+
+
+def registry():
+    return prepare_arg(LANGUAGE_KEYBOARD), prepare_arg(REMOVE_KEYBOARD)
+
+
+def main(iterations=20000):
+    assert per_request() == registry()
+
+    results = {}
+    for name, func in (("build+serialize", per_request), ("registry", registry)):
+        seconds = timeit.timeit(func, number=iterations)
+        results[name] = seconds / iterations * 1e6
+        print(f"{name:<16} {results[name]:8.2f} us/request")
+    print(f"speedup          {results['build+serialize'] / results['registry']:8.1f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
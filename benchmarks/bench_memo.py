@@ -0,0 +1,50 @@
+"""
+Micro-benchmark: sanitizer.sanitize_memo vs the old lxml based strip_html
+
+    python benchmarks/bench_memo.py [iterations]
+
+lxml is no longer a dependency, install it to get the comparison.
+"""
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from sanitizer import sanitize_memo  # noqa: E402
+
+MEMOS = [
+    "obrigado!",
+    "Muito obrigado pela ajuda com o mutirão de ontem 🙏🌱",
+    "valeu demais <b>irmão</b>, &amp; até a próxima",
+    "gracias por todo!!   \n\n   nos vemos en la asamblea",
+    "thanks for <a href=\"https://example.org\">the link</a> &lt;3 " * 4,
+    "Gratidão por facilitar o círculo de hoje, foi lindo ver todo mundo junto 💚 " * 3,
+]
+
+
+def lxml_strip_html(s):
+    from lxml import html
+    return str(html.fromstring(s).text_content())
+
+
+def run(name, func, iterations):
+    seconds = timeit.timeit(lambda: [func(memo) for memo in MEMOS], number=iterations)
+    per_memo = seconds / (iterations * len(MEMOS)) * 1e6
+    print(f"{name:<16} {per_memo:8.2f} us/memo")
+    return per_memo
+
+
+def main(iterations=20000):
+    ours = run("sanitize_memo", sanitize_memo, iterations)
+    try:
+        import lxml  # noqa: F401
+    except ImportError:
+        print("lxml not installed, skipping the comparison")
+        return
+    theirs = run("lxml strip_html", lxml_strip_html, iterations)
+    print(f"speedup          {theirs / ours:8.2f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
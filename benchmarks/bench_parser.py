@@ -0,0 +1,49 @@
+"""
+Throughput of gratz_parser.parse_gratz on typical /gratz messages
+
+    python benchmarks/bench_parser.py [iterations]
+"""
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiogram.types import MessageEntity, User  # noqa: E402
+
+from gratz_parser import parse_gratz  # noqa: E402
+
+
+def utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def message(text, *mentions, text_mention=None):
+    entities = [MessageEntity(type='bot_command', offset=0, length=text.index(' '))]
+    for mention in mentions:
+        entities.append(MessageEntity(type='mention', offset=utf16_len(text[:text.index(mention)]),
+                                      length=utf16_len(mention)))
+    if text_mention:
+        entities.append(MessageEntity(type='text_mention', offset=utf16_len(text[:text.index(text_mention)]),
+                                      length=utf16_len(text_mention),
+                                      user=User(id=1234, is_bot=False, first_name=text_mention)))
+    return text, entities
+
+
+MESSAGES = [
+    message("/gratz @felipenseeds obrigado!", "@felipenseeds"),
+    message("/gratz Maria Clara valeu pela ajuda no mutirão 🌱", text_mention="Maria Clara"),
+    message("/gratz @ana @bob @carla gratidão pelo encontro de hoje 🙏💚", "@ana", "@bob", "@carla"),
+    ("/ack joao muito obrigado", []),
+]
+
+
+def main(iterations=50000):
+    seconds = timeit.timeit(lambda: [parse_gratz(text, entities) for text, entities in MESSAGES],
+                            number=iterations)
+    total = iterations * len(MESSAGES)
+    print(f"parse_gratz {total / seconds:12,.0f} msg/s  {seconds / total * 1e6:6.2f} us/msg")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
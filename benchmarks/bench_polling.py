@@ -0,0 +1,93 @@
+"""
+Polling throughput against a fake Bot API server, no Telegram or database needed
+
+    python benchmarks/bench_polling.py [updates] [handler_ms]
+
+The fake server hands out `updates` messages spread over 50 chats through
+getUpdates and answers every sendMessage; each handler sleeps handler_ms
+(the Hypha/Postgres time) and replies once. The same fake server works for
+the real bot: TELEGRAM_API_SERVER=http://127.0.0.1:<port> python3 polling_worker.py
+"""
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+from aiogram.bot.api import TelegramAPIServer  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+from polling import PollingWorker  # noqa: E402
+from update_queue import UpdateQueue  # noqa: E402
+
+CHATS = 50
+
+
+def fake_update(update_id):
+    chat = {"id": update_id % CHATS + 1, "type": "private", "first_name": "user"}
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": chat, "from": dict(chat, is_bot=False), "text": "/gratz",
+    }}
+
+
+class FakeBotApi:
+    def __init__(self, total):
+        self.total = total
+        self.sent = 0
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = await request.post() if request.can_read_body else {}
+        if method == "getUpdates":
+            offset = int(data.get("offset") or 1)
+            limit = int(data.get("limit") or 100)
+            last = min(self.total, offset + limit - 1)
+            return web.json_response({"ok": True, "result": [fake_update(i) for i in range(offset, last + 1)]})
+        if method == "sendMessage":
+            self.sent += 1
+            chat = {"id": int(data["chat_id"]), "type": "private"}
+            return web.json_response({"ok": True, "result": {"message_id": self.sent, "date": 0, "chat": chat,
+                                                             "text": data.get("text", "")}})
+        return web.json_response({"ok": True, "result": True})
+
+
+async def run(total, workers, handler_seconds):
+    api = FakeBotApi(total)
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    bot = Bot("123456:fake", server=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}"))
+    dp = Dispatcher(bot)
+    worker = PollingWorker(dp, UpdateQueue(dp, workers=workers, maxsize=1000), timeout=0)
+
+    @dp.message_handler()
+    async def reply(message: types.Message):
+        await asyncio.sleep(handler_seconds)
+        await bot.send_message(message.chat.id, "ok")
+        if api.sent >= total:
+            worker.stop()
+
+    started = time.perf_counter()
+    await worker.run()
+    seconds = time.perf_counter() - started
+
+    await (await bot.get_session()).close()
+    await runner.cleanup()
+    print(f"workers={workers:<3} {total / seconds:10,.0f} updates/s  batches={worker.batches}")
+
+
+def main(total=2000, handler_ms=5):
+    for workers in (1, 4, 16, 32):
+        asyncio.run(run(total, workers, handler_ms / 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 5)
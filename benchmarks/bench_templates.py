@@ -0,0 +1,78 @@
+"""
+Rendering the help and signing messages: gettext + str.format vs templates.Template
+
+    python benchmarks/bench_templates.py [iterations]
+"""
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import aiogram.utils.markdown as md  # noqa: E402
+from aiogram.contrib.middlewares.i18n import I18nMiddleware  # noqa: E402
+
+from templates import TemplateCatalog  # noqa: E402
+
+LOCALES_DIR = Path(__file__).resolve().parent.parent / 'locales'
+SETUP_LINK = "https://t.me/SeedsGratidaumBot?start=setup"
+
+FOOTER = '<b>OBS:</b> Nunca compartilhe sua senha com ninguém, e a guarde em lugar seguro.'
+HELP = ('Precisa de ajuda, <b>{full_name}</b>?\n'
+        'Segue uma lista de comandos que você pode usar:\n\n'
+        '🥰 /gratz @nomedapessoa Mensagem de gratidaum\n'
+        '       📜 Envia gratidaum para a pessoa selecionada.\n'
+        '🤔 /ajuda\n'
+        '       📜 Esse menu de ajuda\n\n'
+        '<a href="{start_link_setup}" >🤖 Inicie a configuração CLICANDO AQUI 🤖</a>\n\n'
+        '{msg_footer}')
+CONFIRM = "Confirme o envio da Gratidaum"
+SIGN = ("🥳 Sua Gratidaum está quase chegando para {to} 🎉\n\n"
+        "Você precisa confirmar a transação.\n"
+        "Você tem 2 opções:\n\n"
+        'Clique no link abaixo para assinar com Seeds Wallet/Anchor\n'
+        '{link_confirm_transaction}\n\n'
+        'Ou\n\n'
+        "Escaneie o QR Code abaixo para assinar a transação\n")
+
+LINK = "https://eosio.to/gmNgYmRiKAjiap5_NpVBxFuryErRiJGRAQ"
+
+
+def gettext_path(i18n, locale):
+    _ = i18n.gettext
+    help_text = md.text(_(HELP, locale=locale).format(full_name="Maria Clara", start_link_setup=SETUP_LINK,
+                                                      msg_footer=_(FOOTER, locale=locale)), sep='\n')
+    sign = _(SIGN, locale=locale).format(to="Maria Clara",
+                                         link_confirm_transaction=md.hlink(_(CONFIRM, locale=locale), LINK))
+    return help_text, sign
+
+
+def template_path(templates, help_templates, locale):
+    help_text = help_templates[locale].render(full_name="Maria Clara")
+    sign = templates.render(SIGN, locale, to="Maria Clara",
+                            link_confirm_transaction=md.hlink(templates.text(CONFIRM, locale), LINK))
+    return help_text, sign
+
+
+def main(iterations=50000):
+    i18n = I18nMiddleware('mybot', LOCALES_DIR)
+    templates = TemplateCatalog(i18n)
+    locales = ('pt', 'en', 'es')
+    help_templates = {locale: templates.get(HELP, locale).bind(start_link_setup=SETUP_LINK,
+                                                               msg_footer=templates.text(FOOTER, locale))
+                      for locale in locales}
+
+    for locale in locales:
+        assert gettext_path(i18n, locale) == template_path(templates, help_templates, locale), locale
+
+    results = {}
+    for name, func in (("gettext+format", lambda locale: gettext_path(i18n, locale)),
+                       ("templates", lambda locale: template_path(templates, help_templates, locale))):
+        seconds = timeit.timeit(lambda: [func(locale) for locale in locales], number=iterations)
+        results[name] = seconds / (iterations * len(locales)) * 1e6
+        print(f"{name:<16} {results[name]:8.2f} us/request")
+    print(f"speedup          {results['gettext+format'] / results['templates']:8.2f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
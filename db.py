@@ -1,48 +1,78 @@
 import logging
 import os
+from urllib.parse import urlparse, parse_qsl, unquote
 
 from peewee import *
 import datetime
+import time
 
-db = None
+from metrics import DB_QUERY_SECONDS
 
-logging.basicConfig(level=logging.INFO, force=True)
+log = logging.getLogger("db")
 
 
-DATABASE_URL = os.getenv('DATABASE_URL', None)
+class DatabaseConfig:
+    """Connection settings, from DATABASE_URL or the PG_* variables"""
 
-if not DATABASE_URL:
-    import subprocess
+    def __init__(self, database, host, user, password, port=5432, options=None):
+        self.database = database
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = int(port)
+        # Extra libpq parameters such as sslmode, connect_timeout...
+        self.options = options or {}
 
-    result = subprocess.run("heroku config:get DATABASE_URL -a seeds-gratidaum-bot".split(" "), capture_output=True,
-                            text=True)
-    DATABASE_URL = result.stdout.strip()
-    logging.info(f"DATABASE_URL: got from heroku config:get")
-# try:
-# logging.info(f"DATABASE_URL: {DATABASE_URL}")
-if DATABASE_URL:
-    full = DATABASE_URL.split("//")[1]
-    [part1, part2] = full.split("@")
-    [USER, PASSWORD] = part1.split(":")
-    [part3, DBNAME] = part2.split("/")
-    [HOST, PORT] = part3.split(":")
+    @classmethod
+    def from_url(cls, url):
+        parsed = urlparse(url)
+        if parsed.scheme not in ("postgres", "postgresql"):
+            raise ValueError(f"Unsupported database scheme: {parsed.scheme}")
+        return cls(database=unquote(parsed.path.lstrip("/")),
+                   host=parsed.hostname,
+                   user=unquote(parsed.username) if parsed.username else None,
+                   password=unquote(parsed.password) if parsed.password else None,
+                   port=parsed.port or 5432,
+                   options=dict(parse_qsl(parsed.query)))
 
-VARS = vars()
+    @classmethod
+    def from_env(cls):
+        database_url = os.getenv('DATABASE_URL', None)
+        if database_url:
+            config = cls.from_url(database_url)
+        else:
+            config = cls(database=os.getenv('PG_DBNAME', None),
+                         host=os.getenv('PG_HOST', None),
+                         user=os.getenv('PG_USER', None),
+                         password=os.getenv('PG_PASSWORD', None),
+                         port=os.getenv('PG_PORT', 5432))
+        if os.getenv('PG_SSLMODE'):
+            config.options.setdefault('sslmode', os.getenv('PG_SSLMODE'))
 
-HOST = os.getenv('PG_HOST', None) if 'HOST' not in VARS else HOST
-USER = os.getenv('PG_USER', None) if 'USER' not in VARS else USER
-DBNAME = os.getenv('PG_DBNAME', None) if 'DBNAME' not in VARS else DBNAME
-PORT = os.getenv('PG_PORT', 5432) if 'PORT' not in VARS else PORT
-PASSWORD = os.getenv('PG_PASSWORD', None) if 'PASSWORD' not in VARS else PASSWORD
+        if not config.host or not config.user or not config.database or not config.password:
+            raise Exception(f"Must define DATABASE_URL or PG_HOST PG_USER PG_DBNAME PG_PASSWORD [PG_PORT]")
+        return config
 
-logging.info(f"{HOST},{USER}")
+    def connect_params(self):
+        return dict(host=self.host, port=self.port, user=self.user, password=self.password, **self.options)
 
-if not HOST or not USER or not DBNAME or not PASSWORD:
-    raise Exception(f"Must define PG_HOST PG_USER PG_DBNAME PG_PASSWORD [PG_PORT]")
-else:
-    db = PostgresqlDatabase(DBNAME, host=HOST, user=USER, password=PASSWORD, autorollback=True, autocommit=True)
-# except Exception as e:
-#     logging.error(f"Some error with env database: {e}")
+    def __repr__(self):
+        return f"DatabaseConfig({self.user}@{self.host}:{self.port}/{self.database} {self.options})"
+
+
+class MeteredPostgresqlDatabase(PostgresqlDatabase):
+    """Times every statement for /metrics, labelled by its first keyword (SELECT, INSERT...)"""
+
+    def execute_sql(self, sql, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, statement=sql.split(None, 1)[0].upper())
+
+
+# Deferred until init_db(), importing this module does not touch the network
+db = MeteredPostgresqlDatabase(None, autorollback=True, autocommit=True)
 
 
 class BaseModel(Model):
@@ -52,12 +82,12 @@ class BaseModel(Model):
 
 class DBVersion(BaseModel):
     number = AutoField()
-    created_date = DateTimeField(default=datetime.datetime.now())
+    created_date = DateTimeField(default=datetime.datetime.now)
 
 
 class User(BaseModel):
     pk_id = AutoField()
-    user_id = CharField(primary_key=False, null=True)
+    user_id = CharField(primary_key=False, null=True, unique=True)
     name = CharField(primary_key=False, unique=False)
     username = CharField()
     locale = CharField(null=True)
@@ -65,8 +95,136 @@ class User(BaseModel):
     updated_date = DateTimeField()
 
 
-db.connect()
+# Lookups by name/username are case-insensitive, see migrate3
+User.add_index(User.index(fn.lower(User.name), name="user_name_lower"))
+User.add_index(User.index(fn.lower(User.username), name="user_username_lower"))
+
+
+class FsmState(BaseModel):
+    """Conversation state of one user in one chat, see pg_storage.PostgresStorage"""
+    chat = BigIntegerField()
+    user = BigIntegerField()
+    state = CharField(null=True)
+    data = TextField(default='{}')
+    updated_date = DateTimeField(index=True)
+
+    class Meta:
+        table_name = 'fsm_state'
+        primary_key = CompositeKey('chat', 'user')
+
+
+class Gratitude(BaseModel):
+    """One acknowledge sent through the bot, written in batches by ledger.GratitudeLedger"""
+    id = BigAutoField()
+    sender = BigIntegerField(index=True)  # telegram id
+    recipient = IntegerField(index=True)  # User.pk_id
+    chat = BigIntegerField()
+    memo_hash = CharField(max_length=40)
+    esr_id = CharField(max_length=40, null=True)  # esr_cache.esr_key of the signing request
+    created_date = DateTimeField()
+    recorded_date = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = (
+            (('chat', 'created_date'), False),
+        )
+
+
+class GratitudeCounter(BaseModel):
+    """
+    Gratitudes per chat, day and member, kept up to date by the ledger
+
+    role is given (member is the sender's telegram id), received (member is
+    User.pk_id) or chat (member 0, everything sent in the chat).
+    """
+    chat = BigIntegerField()
+    day = DateField()
+    role = CharField(max_length=8)
+    member = BigIntegerField()
+    name = CharField(null=True)
+    count = IntegerField(default=0)
+
+    class Meta:
+        table_name = 'gratitude_counter'
+        primary_key = CompositeKey('chat', 'day', 'role', 'member')
+
+
+class GratitudeTotal(BaseModel):
+    """All-time rollup of GratitudeCounter, one row per chat, role and member"""
+    chat = BigIntegerField()
+    role = CharField(max_length=8)
+    member = BigIntegerField()
+    name = CharField(null=True)
+    count = IntegerField(default=0)
+
+    class Meta:
+        table_name = 'gratitude_total'
+        primary_key = CompositeKey('chat', 'role', 'member')
+        indexes = (
+            (('chat', 'role', 'count'), False),
+        )
+
+
+class GratitudeWindow(BaseModel):
+    """
+    GratitudeCounter summed over the last `days` days, one row per chat, window, role and member
+
+    The ledger adds new events to every window and gratitude_stats.roll_windows
+    subtracts the days leaving it, so /top reads top_size rows per role.
+    """
+    chat = BigIntegerField()
+    days = IntegerField()
+    role = CharField(max_length=8)
+    member = BigIntegerField()
+    name = CharField(null=True)
+    count = IntegerField(default=0)
+
+    class Meta:
+        table_name = 'gratitude_window'
+        primary_key = CompositeKey('chat', 'days', 'role', 'member')
+        indexes = (
+            (('chat', 'days', 'role', 'count'), False),
+        )
+
+
+class GratitudeWindowState(BaseModel):
+    """Last day already subtracted from each window, days up to it are no longer counted"""
+    days = IntegerField(primary_key=True)
+    expired_through = DateField()
+
+    class Meta:
+        table_name = 'gratitude_window_state'
+
+
+class ProcessedUpdate(BaseModel):
+    """update_ids already taken by some dyno, see dedup.UpdateDeduplicator"""
+    update_id = BigIntegerField(primary_key=True)
+    created_date = DateTimeField(index=True)
+
+    class Meta:
+        table_name = 'processed_update'
+
+
+MODELS = [User, DBVersion, FsmState, Gratitude, GratitudeCounter, GratitudeTotal, ProcessedUpdate,
+          GratitudeWindow, GratitudeWindowState]
+
+
+def init_db(config=None, create_tables=True):
+    """
+    Bind the database and create missing tables, only the first call does anything
+
+    :param config: DatabaseConfig, read from the environment when omitted
+    :param create_tables: run CREATE TABLE IF NOT EXISTS for MODELS, only for a scratch
+        database: migrate.py and the bot leave the schema to the migrations
+    """
+    if not db.deferred:
+        return db
 
-# db.drop_tables([User])
+    config = config if config else DatabaseConfig.from_env()
+    log.info("Database: %s", config)
+    db.init(config.database, **config.connect_params())
 
-db.create_tables([User, DBVersion])
+    if create_tables:
+        with db.connection_context():
+            db.create_tables(MODELS)
+    return db
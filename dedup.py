@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import typing
+from collections import deque
+from datetime import datetime, timedelta
+
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+
+from db import ProcessedUpdate
+from repository import run_db
+
+log = logging.getLogger("dedup")
+
+UPDATE_DEDUP_KEY = 'UPDATE_DEDUP'
+
+# update_ids remembered in memory, Telegram redelivers within minutes so a few thousand is plenty
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", 10000))
+# 1 also claims every update_id in Postgres, needed when several dynos receive updates
+UPDATE_DEDUP_SHARED = os.getenv("UPDATE_DEDUP_SHARED", "0") == "1"
+# Telegram gives up on an update after 24h, older rows are deleted
+UPDATE_DEDUP_TTL = int(os.getenv("UPDATE_DEDUP_TTL", 24 * 60 * 60))
+UPDATE_DEDUP_CLEANUP_INTERVAL = int(os.getenv("UPDATE_DEDUP_CLEANUP_INTERVAL", 10 * 60))
+
+
+class UpdateWindow:
+    """The last `size` update_ids: a deque keeps the order, a set answers lookups in O(1)"""
+
+    def __init__(self, size=UPDATE_DEDUP_WINDOW):
+        self.size = size
+        self._order = deque()
+        self._ids = set()
+
+    def add(self, update_id) -> bool:
+        """False when update_id is already in the window"""
+        if update_id in self._ids:
+            return False
+        self._ids.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.size:
+            self._ids.discard(self._order.popleft())
+        return True
+
+    def discard(self, update_id):
+        if update_id in self._ids:
+            self._ids.discard(update_id)
+            self._order.remove(update_id)
+
+    def __contains__(self, update_id):
+        return update_id in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class UpdateDeduplicator:
+    """
+    Drops updates Telegram delivers again while the first copy is still running
+
+    claim() must be called before the update reaches the dispatcher, so
+    neither middlewares nor handlers ever see the copy. With shared=True the
+    update_id is also inserted in processed_update, the dyno whose INSERT
+    wins processes it. If Postgres is unavailable the update is processed
+    anyway: a rare duplicate is better than a lost Gratidaum.
+    """
+
+    def __init__(self, window=UPDATE_DEDUP_WINDOW, shared=UPDATE_DEDUP_SHARED, ttl=UPDATE_DEDUP_TTL,
+                 cleanup_interval=UPDATE_DEDUP_CLEANUP_INTERVAL):
+        self.window = UpdateWindow(window)
+        self.shared = shared
+        self.ttl = timedelta(seconds=ttl)
+        self.cleanup_interval = cleanup_interval
+        self._cleanup_task: typing.Optional[asyncio.Task] = None
+        self.claimed = 0
+        self.suppressed = 0
+        self.suppressed_shared = 0
+
+    async def claim(self, update_id) -> bool:
+        """True the first time update_id is seen, False for duplicates"""
+        if not self.window.add(update_id):
+            self.suppressed += 1
+            log.info("Suppressed duplicated update %s", update_id)
+            return False
+
+        if self.shared:
+            try:
+                fresh = await run_db(self._claim_shared, update_id)
+            except Exception as e:
+                log.error("Shared dedup failed for update %s => Error %s", update_id, e)
+                fresh = True
+            if not fresh:
+                self.suppressed += 1
+                self.suppressed_shared += 1
+                log.info("Suppressed update %s already taken by another dyno", update_id)
+                return False
+
+        self.claimed += 1
+        return True
+
+    async def release(self, update_id):
+        """Forget update_id, for updates rejected before processing that Telegram will send again"""
+        self.window.discard(update_id)
+        if self.shared:
+            try:
+                await run_db(self._release_shared, update_id)
+            except Exception as e:
+                log.error("Shared dedup release failed for update %s => Error %s", update_id, e)
+
+    def start_cleanup(self):
+        if self.shared and (self._cleanup_task is None or self._cleanup_task.done()):
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self):
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            try:
+                await self._cleanup_task
+            except asyncio.CancelledError:
+                pass
+            self._cleanup_task = None
+
+    # Sync helpers, they run on the DB thread pool
+
+    @staticmethod
+    def _claim_shared(update_id):
+        inserted = (ProcessedUpdate
+                    .insert(update_id=update_id, created_date=datetime.now())
+                    .on_conflict_ignore()
+                    .returning(ProcessedUpdate.update_id)
+                    .execute())
+        return len(list(inserted)) > 0
+
+    @staticmethod
+    def _release_shared(update_id):
+        ProcessedUpdate.delete().where(ProcessedUpdate.update_id == update_id).execute()
+
+    def _delete_expired(self):
+        return (ProcessedUpdate
+                .delete()
+                .where(ProcessedUpdate.created_date <= datetime.now() - self.ttl)
+                .execute())
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                removed = await run_db(self._delete_expired)
+                if removed:
+                    log.info("Removed %s expired processed updates", removed)
+            except Exception as e:
+                log.error("Processed update cleanup failed => Error %s", e)
+
+    def stats(self):
+        return {
+            "window": len(self.window),
+            "shared": self.shared,
+            "claimed": self.claimed,
+            "suppressed": self.suppressed,
+            "suppressed_shared": self.suppressed_shared,
+        }
+
+
+class DedupWebhookRequestHandler(WebhookRequestHandler):
+    """aiogram's webhook view, dropping duplicated updates before the dispatcher sees them"""
+
+    async def process_update(self, update):
+        dedup: typing.Optional[UpdateDeduplicator] = self.request.app.get(UPDATE_DEDUP_KEY)
+        if dedup is not None and not await dedup.claim(update.update_id):
+            return None
+        return await super().process_update(update)
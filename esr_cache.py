@@ -0,0 +1,66 @@
+import hashlib
+import logging
+import os
+
+from cache import TTLCache, MISSING
+
+log = logging.getLogger("esr_cache")
+
+ESR_CACHE_SIZE = int(os.getenv("ESR_CACHE_SIZE", 2000))
+ESR_CACHE_TTL = float(os.getenv("ESR_CACHE_TTL", 6 * 60 * 60))
+
+
+def normalize_memo(memo):
+    """Collapse whitespace, the memo that goes on-chain is the normalized one"""
+    return ' '.join(memo.split()) if memo else ''
+
+
+def esr_key(account, memo):
+    """Content address of a signing request: target account(s) + normalized memo"""
+    accounts = account if isinstance(account, str) else ",".join(account)
+    return hashlib.sha1(f"{accounts}\0{normalize_memo(memo)}".encode()).hexdigest()
+
+
+class EsrCache:
+    """
+    Signing requests already produced, keyed by esr_key().
+
+    The ESR only depends on the target account and the memo (the signer is a
+    placeholder), so a repeated "obrigado!" to the same person never goes
+    back to Hypha. Formatted sign/QR messages are kept per locale as well.
+    """
+
+    def __init__(self, maxsize=ESR_CACHE_SIZE, ttl=ESR_CACHE_TTL):
+        self.responses = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.messages = TTLCache(maxsize=maxsize, ttl=ttl)
+        # Telegram file_id of the QR photo already uploaded for an esr URI
+        self.photos = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get_qr(self, client, account, memo=''):
+        memo = normalize_memo(memo)
+        key = esr_key(account, memo)
+        response = self.responses.get(key)
+        if response is MISSING:
+            response = await client.get_qr(account=account, memo=memo)
+            # Only cache real signing requests, never an error body
+            if isinstance(response, dict) and response.get("esr"):
+                self.responses.set(key, response)
+        return response
+
+    def get_messages(self, account, memo, locale, to_who):
+        messages = self.messages.get((esr_key(account, memo), locale, to_who))
+        return None if messages is MISSING else messages
+
+    def set_messages(self, account, memo, locale, to_who, messages):
+        self.messages.set((esr_key(account, memo), locale, to_who), messages)
+
+    def get_photo(self, esr):
+        file_id = self.photos.get(esr)
+        return None if file_id is MISSING else file_id
+
+    def set_photo(self, esr, file_id):
+        self.photos.set(esr, file_id)
+
+    def stats(self):
+        return {"responses": self.responses.stats(), "messages": self.messages.stats(),
+                "photos": self.photos.stats()}
@@ -0,0 +1,148 @@
+"""
+In-process EOSIO Signing Request (ESR, EEP-7 v2) encoder.
+
+Produces the same ``esr://`` URI the Hypha service returns for our fixed
+``gratz.seeds::acknowledge`` template: the request is serialized with the
+EOSIO binary format, deflated (raw, default zlib settings, only kept when
+smaller) and base64url encoded without padding.
+"""
+import base64
+import io
+import os
+import re
+import struct
+import zlib
+
+ESR_VERSION = 2
+# ChainName alias from the ESR spec, 2 = Telos (where SEEDS lives)
+ESR_CHAIN_ALIAS = int(os.getenv("ESR_CHAIN_ALIAS", 2))
+
+FLAG_BROADCAST = 1 << 0
+
+_NAME_CHARS = ".12345abcdefghijklmnopqrstuvwxyz"
+_NAME_VALUES = {c: i for i, c in enumerate(_NAME_CHARS)}
+# Same check as eosjs: the 13th character only has 4 bits, so it must be one of .1-5a-j
+_NAME_RE = re.compile(r"^[.1-5a-z]{0,12}[.1-5a-j]?$")
+
+
+def encode_name(name):
+    """EOSIO name (up to 13 chars) to its uint64 value"""
+    if not isinstance(name, str) or not _NAME_RE.fullmatch(name):
+        raise ValueError(f"Invalid EOSIO name: {name}")
+    value = 0
+    for i in range(13):
+        c = _NAME_VALUES[name[i]] if i < len(name) else 0
+        if i < 12:
+            value |= (c & 0x1f) << (64 - 5 * (i + 1))
+        else:
+            value |= c & 0x0f
+    return value
+
+
+class Writer:
+    """Minimal EOSIO binary serializer"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def uint8(self, value):
+        self.buffer.append(value)
+        return self
+
+    def varuint32(self, value):
+        while True:
+            byte = value & 0x7f
+            value >>= 7
+            if value:
+                self.buffer.append(byte | 0x80)
+            else:
+                self.buffer.append(byte)
+                return self
+
+    def name(self, value):
+        self.buffer += struct.pack("<Q", encode_name(value))
+        return self
+
+    def bytes(self, value):
+        self.varuint32(len(value))
+        self.buffer += value
+        return self
+
+    def string(self, value):
+        return self.bytes(value.encode("utf-8"))
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+
+def _acknowledge_data(data):
+    return Writer().name(data["from"]).name(data["to"]).string(data.get("memo") or '').getvalue()
+
+
+# Actions we know how to serialize without fetching the contract ABI
+ACTION_SERIALIZERS = {
+    ("gratz.seeds", "acknowledge"): _acknowledge_data,
+}
+
+
+def _write_action(writer, action):
+    serializer = ACTION_SERIALIZERS.get((action["account"], action["name"]))
+    if serializer is None:
+        raise ValueError(f"No serializer for {action['account']}::{action['name']}")
+    writer.name(action["account"]).name(action["name"])
+    writer.varuint32(len(action["authorization"]))
+    for auth in action["authorization"]:
+        writer.name(auth["actor"]).name(auth["permission"])
+    writer.bytes(serializer(action["data"]))
+
+
+def _base64u(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def encode_actions(actions, chain_alias=ESR_CHAIN_ALIAS, broadcast=True, callback=''):
+    """
+    Encode a signing request for the given actions
+
+    :param actions: list of action dicts, as posted to the Hypha service
+    :return: "esr://..." URI
+    """
+    writer = Writer()
+    # chain_id: variant<chain_alias, chain_id>
+    writer.uint8(0).uint8(chain_alias)
+    # req: variant<action, action[], transaction, identity>
+    if len(actions) == 1:
+        writer.uint8(0)
+        _write_action(writer, actions[0])
+    else:
+        writer.uint8(1).varuint32(len(actions))
+        for action in actions:
+            _write_action(writer, action)
+    writer.uint8(FLAG_BROADCAST if broadcast else 0)
+    writer.string(callback)
+    # info: vector<info_pair>
+    writer.varuint32(0)
+
+    header = ESR_VERSION
+    payload = writer.getvalue()
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    deflated = compressor.compress(payload) + compressor.flush()
+    if len(deflated) < len(payload):
+        header |= 1 << 7
+        payload = deflated
+    return "esr://" + _base64u(bytes([header]) + payload)
+
+
+def encode_request(request):
+    """Same shape as the Hypha /qr response, without the hosted QR image"""
+    return {"esr": encode_actions(request["actions"]), "qr": None}
+
+
+def qr_png(uri):
+    """Render the URI as a QR code PNG, needs the optional qrcode package"""
+    import qrcode
+
+    image = qrcode.make(uri)
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
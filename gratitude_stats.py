@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import os
+import typing
+from datetime import date, timedelta
+
+from peewee import EXCLUDED, fn
+
+from cache import TTLCache, MISSING
+from db import db, GratitudeCounter, GratitudeTotal, GratitudeWindow, GratitudeWindowState
+from repository import run_db
+
+log = logging.getLogger("gratitude_stats")
+
+GIVEN = "given"
+RECEIVED = "received"
+CHAT = "chat"
+
+STATS_CACHE_SIZE = int(os.getenv("STATS_CACHE_SIZE", 1024))
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", 30))
+STATS_TOP_SIZE = int(os.getenv("STATS_TOP_SIZE", 10))
+# /top periods kept as rolling totals, other periods are answered with the next larger window
+STATS_WINDOWS = tuple(sorted(int(days) for days in os.getenv("STATS_WINDOWS", "7,30,90,365").split(",")))
+STATS_ROLL_INTERVAL = int(os.getenv("STATS_ROLL_INTERVAL", 10 * 60))
+
+
+def _rollup(events):
+    """Ledger events -> {(chat, day, role, member): [name, count]}"""
+    counters = {}
+
+    def add(key, name):
+        counter = counters.setdefault(key, [None, 0])
+        counter[0] = name or counter[0]
+        counter[1] += 1
+
+    for event in events:
+        chat, day = event["chat"], event["created_date"].date()
+        add((chat, day, GIVEN, event["sender"]), event.get("sender_name"))
+        add((chat, day, RECEIVED, event["recipient"]), event.get("recipient_name"))
+        add((chat, day, CHAT, 0), None)
+    return counters
+
+
+def write_counters(events):
+    """
+    Add a batch of ledger events to the daily counters and the totals
+
+    Sync, runs inside the ledger's transaction so events and counters never
+    disagree. Keys are sorted to take row locks in the same order on every dyno.
+    """
+    counters = _rollup(events)
+    if not counters:
+        return
+
+    totals = {}
+    for (chat, _day, role, member), (name, count) in counters.items():
+        total = totals.setdefault((chat, role, member), [None, 0])
+        total[0] = name or total[0]
+        total[1] += count
+
+    (GratitudeCounter
+     .insert_many([dict(chat=chat, day=day, role=role, member=member, name=name, count=count)
+                   for (chat, day, role, member), (name, count) in sorted(counters.items())])
+     .on_conflict(conflict_target=[GratitudeCounter.chat, GratitudeCounter.day,
+                                   GratitudeCounter.role, GratitudeCounter.member],
+                  update={GratitudeCounter.count: GratitudeCounter.count + EXCLUDED.count,
+                          GratitudeCounter.name: fn.COALESCE(EXCLUDED.name, GratitudeCounter.name)})
+     .execute())
+    (GratitudeTotal
+     .insert_many([dict(chat=chat, role=role, member=member, name=name, count=count)
+                   for (chat, role, member), (name, count) in sorted(totals.items())])
+     .on_conflict(conflict_target=[GratitudeTotal.chat, GratitudeTotal.role, GratitudeTotal.member],
+                  update={GratitudeTotal.count: GratitudeTotal.count + EXCLUDED.count,
+                          GratitudeTotal.name: fn.COALESCE(EXCLUDED.name, GratitudeTotal.name)})
+     .execute())
+
+    # FOR SHARE: a concurrent roll_windows waits for this batch, and this batch for it
+    expired = dict(GratitudeWindowState
+                   .select(GratitudeWindowState.days, GratitudeWindowState.expired_through)
+                   .for_update('FOR SHARE')
+                   .tuples())
+    windows = {}
+    for (chat, day, role, member), (name, count) in counters.items():
+        for days, expired_through in expired.items():
+            # Days already rolled out must not be added, nothing would subtract them again
+            if day > expired_through:
+                window = windows.setdefault((chat, days, role, member), [None, 0])
+                window[0] = name or window[0]
+                window[1] += count
+    if windows:
+        (GratitudeWindow
+         .insert_many([dict(chat=chat, days=days, role=role, member=member, name=name, count=count)
+                       for (chat, days, role, member), (name, count) in sorted(windows.items())])
+         .on_conflict(conflict_target=[GratitudeWindow.chat, GratitudeWindow.days,
+                                       GratitudeWindow.role, GratitudeWindow.member],
+                      update={GratitudeWindow.count: GratitudeWindow.count + EXCLUDED.count,
+                              GratitudeWindow.name: fn.COALESCE(EXCLUDED.name, GratitudeWindow.name)})
+         .execute())
+
+
+def _fill_window(days, today):
+    """(Re)build a window from the daily counters, for a window that has no state yet"""
+    expired_through = today - timedelta(days=days)
+    GratitudeWindow.delete().where(GratitudeWindow.days == days).execute()
+    source = (GratitudeCounter
+              .select(GratitudeCounter.chat, days, GratitudeCounter.role, GratitudeCounter.member,
+                      fn.MAX(GratitudeCounter.name), fn.SUM(GratitudeCounter.count))
+              .where(GratitudeCounter.day > expired_through)
+              .group_by(GratitudeCounter.chat, GratitudeCounter.role, GratitudeCounter.member))
+    (GratitudeWindow
+     .insert_from(source, [GratitudeWindow.chat, GratitudeWindow.days, GratitudeWindow.role,
+                           GratitudeWindow.member, GratitudeWindow.name, GratitudeWindow.count])
+     .execute())
+    GratitudeWindowState.create(days=days, expired_through=expired_through)
+    log.info("Filled the %s days window", days)
+
+
+def _expire_window(days, first, last):
+    """Subtract the daily counters of first..last from a window"""
+    expired = (GratitudeCounter
+               .select(GratitudeCounter.chat, GratitudeCounter.role, GratitudeCounter.member,
+                       fn.SUM(GratitudeCounter.count).alias('count'))
+               .where(GratitudeCounter.day.between(first, last))
+               .group_by(GratitudeCounter.chat, GratitudeCounter.role, GratitudeCounter.member)
+               .alias('expired'))
+    (GratitudeWindow
+     .update(count=GratitudeWindow.count - expired.c.count)
+     .from_(expired)
+     .where((GratitudeWindow.days == days)
+            & (GratitudeWindow.chat == expired.c.chat)
+            & (GratitudeWindow.role == expired.c.role)
+            & (GratitudeWindow.member == expired.c.member))
+     .execute())
+    GratitudeWindow.delete().where((GratitudeWindow.days == days) & (GratitudeWindow.count <= 0)).execute()
+
+
+def roll_windows(windows=STATS_WINDOWS, today=None):
+    """
+    Move every window forward to today, sync
+
+    Each window rolls in its own transaction with its state row locked, so
+    dynos running this at the same time never subtract a day twice.
+    """
+    today = today or date.today()
+    rolled = 0
+    for days in windows:
+        with db.atomic():
+            state = (GratitudeWindowState
+                     .select()
+                     .where(GratitudeWindowState.days == days)
+                     .for_update()
+                     .first())
+            if state is None:
+                _fill_window(days, today)
+                continue
+            target = today - timedelta(days=days)
+            if state.expired_through >= target:
+                continue
+            _expire_window(days, state.expired_through + timedelta(days=1), target)
+            state.expired_through = target
+            state.save()
+            rolled += 1
+    return rolled
+
+
+class GratitudeStats:
+    """
+    /top and /stats answers, read from the pre-aggregated counters
+
+    /top reads the top_size rows of each role from the all-time totals or
+    from a rolling window (an index on (chat, [days,] role, count) serves
+    them), so its cost depends neither on the events recorded nor on the
+    chat's members. Answers are cached for ttl seconds, so a burst of /top in
+    a group hits the DB once. start() keeps the windows rolling.
+    """
+
+    def __init__(self, maxsize=STATS_CACHE_SIZE, ttl=STATS_CACHE_TTL, top_size=STATS_TOP_SIZE,
+                 windows=STATS_WINDOWS, roll_interval=STATS_ROLL_INTERVAL):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.top_size = top_size
+        self.windows = windows
+        self.roll_interval = roll_interval
+        self._roll_task: typing.Optional[asyncio.Task] = None
+
+    async def _cached(self, key, func, *args):
+        value = self.cache.get(key)
+        if value is MISSING:
+            value = await run_db(func, *args)
+            self.cache.set(key, value)
+        return value
+
+    def window(self, days):
+        """The smallest window covering days, the largest one for longer periods, None for all time"""
+        if days is None:
+            return None
+        return next((window for window in self.windows if window >= days), self.windows[-1])
+
+    async def top(self, chat, days=None):
+        """
+        :param days: one of the windows (see window()), None for all time
+        :return: dict with given and received [(name, count)] rankings and the chat total
+        """
+        return await self._cached(("top", chat, days), self._top, chat, days)
+
+    async def member(self, telegram_id, pk_id=None, chat=None):
+        """
+        :param pk_id: User.pk_id, needed for the received counts
+        :param chat: only this chat, every chat when None
+        :return: dict with given/received totals and the same for the last 7 days
+        """
+        return await self._cached(("member", telegram_id, pk_id, chat), self._member, telegram_id, pk_id, chat)
+
+    def start(self):
+        if self._roll_task is None or self._roll_task.done():
+            self._roll_task = asyncio.create_task(self._roll_loop())
+
+    async def close(self):
+        if self._roll_task is not None:
+            self._roll_task.cancel()
+            try:
+                await self._roll_task
+            except asyncio.CancelledError:
+                pass
+            self._roll_task = None
+
+    async def _roll_loop(self):
+        while True:
+            try:
+                rolled = await run_db(roll_windows, self.windows)
+                if rolled:
+                    log.info("Rolled %s gratitude windows", rolled)
+            except Exception as e:
+                log.error("Gratitude window roll failed => Error %s", e)
+            await asyncio.sleep(self.roll_interval)
+
+    def stats(self):
+        return self.cache.stats()
+
+    # Sync helpers, they run on the DB thread pool
+
+    def _top(self, chat, days):
+        if days is None:
+            model, where = GratitudeTotal, GratitudeTotal.chat == chat
+        else:
+            model = GratitudeWindow
+            where = (GratitudeWindow.chat == chat) & (GratitudeWindow.days == self.window(days))
+
+        def ranking(role):
+            return [(name, count) for name, count in (model
+                                                      .select(model.name, model.count)
+                                                      .where(where & (model.role == role))
+                                                      .order_by(model.count.desc())
+                                                      .limit(self.top_size)
+                                                      .tuples())]
+
+        total = model.select(model.count).where(where & (model.role == CHAT)).scalar()
+        return {"given": ranking(GIVEN), "received": ranking(RECEIVED), "total": total or 0}
+
+    @staticmethod
+    def _member(telegram_id, pk_id, chat):
+        def where(model):
+            clause = (model.role == GIVEN) & (model.member == telegram_id)
+            if pk_id is not None:
+                clause |= (model.role == RECEIVED) & (model.member == pk_id)
+            return clause if chat is None else clause & (model.chat == chat)
+
+        totals = (GratitudeTotal
+                  .select(GratitudeTotal.role, fn.SUM(GratitudeTotal.count))
+                  .where(where(GratitudeTotal))
+                  .group_by(GratitudeTotal.role)
+                  .tuples())
+        week = (GratitudeCounter
+                .select(GratitudeCounter.role, fn.SUM(GratitudeCounter.count))
+                .where(where(GratitudeCounter) & (GratitudeCounter.day > date.today() - timedelta(days=7)))
+                .group_by(GratitudeCounter.role)
+                .tuples())
+
+        result = {"given": 0, "received": 0, "given_week": 0, "received_week": 0}
+        for role, count in totals:
+            result[role] = int(count)
+        for role, count in week:
+            result[f"{role}_week"] = int(count)
+        return result
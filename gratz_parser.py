@@ -0,0 +1,140 @@
+from aiogram.types import MessageEntityType
+
+_MENTIONS = (MessageEntityType.MENTION, MessageEntityType.TEXT_MENTION)
+
+
+class Recipient:
+    """
+    One person being thanked.
+
+    user_id is only known for text mentions (users without a username),
+    plain @mentions only carry the name. offset/length are UTF-16 units,
+    as in Telegram entities.
+    """
+    __slots__ = ('user_id', 'name', 'offset', 'length')
+
+    def __init__(self, user_id, name, offset, length):
+        self.user_id = user_id
+        self.name = name
+        self.offset = offset
+        self.length = length
+
+    def __repr__(self):
+        return f"Recipient(user_id={self.user_id!r}, name={self.name!r})"
+
+
+class GratzCommand:
+    """/gratz @someone [@other ...] memo, parsed in a single pass"""
+    __slots__ = ('command', 'recipients', 'memo', 'memo_offset')
+
+    def __init__(self, command, recipients, memo, memo_offset):
+        self.command = command
+        self.recipients = recipients
+        self.memo = memo
+        self.memo_offset = memo_offset
+
+    def __repr__(self):
+        return f"GratzCommand(command={self.command!r}, recipients={self.recipients!r}, memo={self.memo!r})"
+
+
+class _Utf16Text:
+    """Slices text by UTF-16 offsets, free when the text has no astral characters (e.g. emoji)"""
+    __slots__ = ('text', 'encoded')
+
+    def __init__(self, text):
+        self.text = text
+        encoded = text.encode('utf-16-le')
+        self.encoded = encoded if len(encoded) != 2 * len(text) else None
+
+    def __len__(self):
+        return len(self.text) if self.encoded is None else len(self.encoded) // 2
+
+    def slice(self, start, end=None):
+        if self.encoded is None:
+            return self.text[start:end]
+        return self.encoded[start * 2:None if end is None else end * 2].decode('utf-16-le')
+
+    def char(self, offset):
+        """Single UTF-16 unit, half of a surrogate pair for astral characters"""
+        if self.encoded is None:
+            return self.text[offset]
+        return chr(self.encoded[offset * 2] | self.encoded[offset * 2 + 1] << 8)
+
+
+def parse_gratz(text, entities=None):
+    """
+    Parse a /gratz (or /ack) message
+
+    Leading mentions, separated by whitespace, are the recipients and the
+    rest of the text is the memo. When the mentions come after some words
+    ("/gratz valeu @ana pela ajuda") the first group of mentions are the
+    recipients and the words before them go to the start of the memo. Only a
+    message without any mention entity takes its first word as the recipient
+    name, as users often type the name without @.
+
+    :param text: message.text
+    :param entities: message.entities
+    :return: GratzCommand, recipients is empty when nobody was mentioned
+    """
+    text = text or ''
+    entities = entities or ()
+    utf16 = _Utf16Text(text)
+    size = len(utf16)
+
+    command = None
+    position = 0
+    by_offset = {}
+    for entity in entities:
+        if entity.type == MessageEntityType.BOT_COMMAND and entity.offset == 0:
+            command = utf16.slice(0, entity.length).split('@', 1)[0].lstrip('/')
+            position = entity.length
+        elif entity.type in _MENTIONS:
+            by_offset[entity.offset] = entity
+
+    if command is None and text.startswith('/'):
+        end = text.find(' ')
+        command = (text if end < 0 else text[:end]).split('@', 1)[0].lstrip('/')
+        position = len(text) if end < 0 else end
+
+    while position < size and utf16.char(position).isspace():
+        position += 1
+    prefix = ''
+    if by_offset and position not in by_offset:
+        start = min((offset for offset in by_offset if offset >= position), default=None)
+        if start is not None:
+            prefix = utf16.slice(position, start).strip()
+            position = start
+
+    recipients = []
+    seen = set()
+    while True:
+        while position < size and utf16.char(position).isspace():
+            position += 1
+        if position >= size:
+            break
+
+        entity = by_offset.get(position)
+        if entity is not None:
+            name = utf16.slice(entity.offset, entity.offset + entity.length)
+            user = entity.user if entity.type == MessageEntityType.TEXT_MENTION else None
+            recipient = Recipient(user.id if user else None, name.lstrip('@'), entity.offset, entity.length)
+            position = entity.offset + entity.length
+        elif (not recipients and not by_offset) or utf16.char(position) == '@':
+            # No mention entity here (name typed without @, or not a valid username), use the word
+            end = position
+            while end < size and not utf16.char(end).isspace():
+                end += 1
+            recipient = Recipient(None, utf16.slice(position, end).lstrip('@'), position, end - position)
+            position = end
+        else:
+            break
+
+        key = recipient.user_id if recipient.user_id else recipient.name.lower()
+        if recipient.name and key not in seen:
+            seen.add(key)
+            recipients.append(recipient)
+
+    memo = utf16.slice(position).strip() if position < size else ''
+    if prefix:
+        memo = f"{prefix} {memo}" if memo else prefix
+    return GratzCommand(command, tuple(recipients), memo, position)
@@ -1,5 +1,35 @@
-from lxml import html
+import logging
+import time
+from contextlib import contextmanager
+
+from sanitizer import strip_tags
 
 
 def strip_html(s):
-    return str(html.fromstring(s).text_content())
+    return strip_tags(s)
+
+
+class StartupReport:
+    """Collects how long each startup phase took and logs it in one line"""
+
+    def __init__(self):
+        self.phases = []
+
+    def add(self, name, seconds):
+        self.phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def summary(self):
+        total = sum(seconds for _, seconds in self.phases)
+        parts = [f"{name}={seconds * 1000:.1f}ms" for name, seconds in self.phases]
+        return " ".join(parts + [f"total={total * 1000:.1f}ms"])
+
+    def log(self, logger=logging):
+        logger.info("Startup report: %s", self.summary())
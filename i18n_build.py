@@ -1,9 +1,141 @@
-import os
+"""
+Extract, update and compile the translations, then check them
 
-os.system("pybabel extract --input-dirs=webhook_server.py -o locales/mybot.pot")
+    python3 i18n_build.py [--allow-incomplete]
 
-# os.system("pybabel init -i locales/mybot.pot -d locales -D mybot -l en")
-# os.system("pybabel init -i locales/mybot.pot -d locales -D mybot -l es")
+Strings are extracted from every module of the bot (benchmarks excluded),
+each locale's .po is updated and compiled to .mo, and a coverage report is
+printed. The build fails when a locale has missing or fuzzy entries, so
+they are found here instead of by users reading Portuguese. Finally the
+translations are written to locales/mybot.json, which the bot loads at
+startup (see templates.load_translations).
+"""
+import argparse
+import json
+import sys
+from datetime import datetime
+from pathlib import Path
 
-os.system(" pybabel update -d locales -D mybot -i locales/mybot.pot")
-os.system("pybabel compile -d locales -D mybot")
\ No newline at end of file
+from babel.messages.catalog import Catalog
+from babel.messages.extract import extract_from_file, DEFAULT_KEYWORDS
+from babel.messages.mofile import write_mo
+from babel.messages.pofile import read_po, write_po
+
+BASE_DIR = Path(__file__).parent
+LOCALES_DIR = BASE_DIR / 'locales'
+DOMAIN = 'mybot'
+SKIP_DIRS = {'benchmarks', 'locales', '__pycache__', '.git', 'venv', '.venv'}
+
+
+def modules():
+    for path in sorted(BASE_DIR.rglob('*.py')):
+        if not SKIP_DIRS.intersection(path.relative_to(BASE_DIR).parts[:-1]):
+            yield path
+
+
+def extract():
+    """Every _/gettext/N_ call in the bot's modules"""
+    template = Catalog(project='Seeds Gratidaum Bot', charset='utf-8', creation_date=datetime.now())
+    for path in modules():
+        filename = path.relative_to(BASE_DIR).as_posix()
+        for lineno, message, comments, context in extract_from_file('python', str(path), keywords=DEFAULT_KEYWORDS,
+                                                                   strip_comment_tags=True):
+            template.add(message, None, [(filename, lineno)], auto_comments=comments, context=context)
+    return template
+
+
+def locale_dirs():
+    return sorted(path for path in LOCALES_DIR.iterdir() if (path / 'LC_MESSAGES' / f'{DOMAIN}.po').exists())
+
+
+def update(template, po_path):
+    with open(po_path, 'rb') as fp:
+        catalog = read_po(fp, locale=po_path.parent.parent.name, domain=DOMAIN)
+    catalog.update(template)
+    with open(po_path, 'wb') as fp:
+        write_po(fp, catalog, width=76, ignore_obsolete=True)
+    return catalog
+
+
+def compile_mo(catalog, mo_path):
+    with open(mo_path, 'wb') as fp:
+        write_mo(fp, catalog)
+
+
+def coverage(catalog):
+    """(translated, fuzzy msgids, missing msgids) of a catalog"""
+    translated, fuzzy, missing = 0, [], []
+    for message in catalog:
+        if not message.id:
+            continue
+        strings = message.string if isinstance(message.string, (list, tuple)) else [message.string]
+        if message.fuzzy:
+            fuzzy.append(message.id)
+        elif not all(strings):
+            missing.append(message.id)
+        else:
+            translated += 1
+    return translated, fuzzy, missing
+
+
+def lookup(catalog):
+    """msgid -> msgstr for the translated entries, plurals as [forms...] under 'singular\\x00plural'"""
+    messages = {}
+    for message in catalog:
+        if not message.id or message.fuzzy:
+            continue
+        if message.pluralizable:
+            if all(message.string):
+                messages['\x00'.join(message.id)] = list(message.string)
+        elif message.string:
+            messages[message.id] = message.string
+    return {"plural": catalog.plural_expr, "messages": messages}
+
+
+def short(msgid):
+    text = msgid if isinstance(msgid, str) else msgid[0]
+    text = text.replace('\n', ' ')
+    return text if len(text) <= 60 else text[:57] + '...'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the bot's translations")
+    parser.add_argument('--allow-incomplete', action='store_true',
+                        help="write everything even with missing or fuzzy entries, exit 0")
+    args = parser.parse_args(argv)
+
+    template = extract()
+    with open(LOCALES_DIR / f'{DOMAIN}.pot', 'wb') as fp:
+        write_po(fp, template, width=76)
+    total = len([message for message in template if message.id])
+    print(f"Extracted {total} messages")
+
+    artifact = {}
+    incomplete = False
+    for locale_dir in locale_dirs():
+        locale = locale_dir.name
+        messages_dir = locale_dir / 'LC_MESSAGES'
+        catalog = update(template, messages_dir / f'{DOMAIN}.po')
+        compile_mo(catalog, messages_dir / f'{DOMAIN}.mo')
+        artifact[locale] = lookup(catalog)
+
+        translated, fuzzy, missing = coverage(catalog)
+        print(f"{locale}: {translated}/{total} translated ({translated / total:.0%}), "
+              f"{len(fuzzy)} fuzzy, {len(missing)} missing")
+        for msgid in fuzzy:
+            print(f"    fuzzy    {short(msgid)}")
+        for msgid in missing:
+            print(f"    missing  {short(msgid)}")
+        incomplete = incomplete or bool(fuzzy or missing)
+
+    with open(LOCALES_DIR / f'{DOMAIN}.json', 'w', encoding='utf-8') as fp:
+        json.dump(artifact, fp, ensure_ascii=False, sort_keys=True, indent=1)
+
+    if incomplete and not args.allow_incomplete:
+        print("Translations are incomplete, fix the .po files or use --allow-incomplete")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
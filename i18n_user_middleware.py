@@ -1,17 +1,54 @@
 import logging
+import os
 
 from aiogram.contrib.middlewares.i18n import I18nMiddleware
 from aiogram.types import Message
 
-from db import User
+from cache import TTLCache, MISSING
+from repository import users
+from templates import load_translations
 
 # logging.basicConfig(level=logging.INFO)
 
 log = logging.getLogger("i18n_user")
 
+LOCALE_CACHE_SIZE = int(os.getenv("LOCALE_CACHE_SIZE", 10000))
+LOCALE_CACHE_TTL = float(os.getenv("LOCALE_CACHE_TTL", 3600))
+# Unknown users are cached for less time, they usually register right after /start
+LOCALE_CACHE_NEGATIVE_TTL = float(os.getenv("LOCALE_CACHE_NEGATIVE_TTL", 60))
+
 
 class I18nUserMiddleware(I18nMiddleware):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # self.locales is taken by I18nMiddleware (the loaded translations)
+        self.user_locales = TTLCache(maxsize=LOCALE_CACHE_SIZE, ttl=LOCALE_CACHE_TTL)
+
+    def find_locales(self):
+        """The build's lookup artifact instead of parsing every .mo"""
+        return load_translations(self.path, self.domain)
+
+    def remember_locale(self, user_id, locale):
+        """Write-through update after the user's locale was saved"""
+        self.user_locales.set(int(user_id), locale)
+
+    def forget_locale(self, user_id):
+        self.user_locales.invalidate(int(user_id))
+
+    async def get_cached_locale(self, user_id):
+        locale = self.user_locales.get(user_id)
+        if locale is not MISSING:
+            return locale
+
+        has_user = await users.get_by_telegram_id(user_id)
+        if has_user:
+            locale = has_user.locale if has_user.locale else None
+            self.user_locales.set(user_id, locale)
+        else:
+            self.user_locales.set(user_id, None, ttl=LOCALE_CACHE_NEGATIVE_TTL)
+        return locale
+
     async def trigger(self, action, args):
         """
         Event trigger
@@ -26,11 +63,8 @@ class I18nUserMiddleware(I18nMiddleware):
             message: Message = args[0]
             user_id = message['from']['id']
 
-            has_user = User.get_or_none(user_id=user_id)
-            locale = None
-            if has_user:
-                locale = has_user.locale if has_user.locale else None
-            log.info(f"data: {message.from_user.id}, locale:{locale}")
+            locale = await self.get_cached_locale(user_id)
+            log.debug("user: %s, locale:%s", message.from_user.id, locale)
             # locale = await self.get_user_locale(action, args)
             self.ctx_locale.set(locale)
             return True
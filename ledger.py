@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import logging
+import os
+import typing
+from datetime import datetime
+
+from db import db, Gratitude
+from gratitude_stats import write_counters
+from repository import run_db
+
+log = logging.getLogger("ledger")
+
+# Flush when this many events are waiting or every GRATITUDE_FLUSH_INTERVAL seconds
+GRATITUDE_BATCH_SIZE = int(os.getenv("GRATITUDE_BATCH_SIZE", 100))
+GRATITUDE_FLUSH_INTERVAL = float(os.getenv("GRATITUDE_FLUSH_INTERVAL", 5))
+# While the database is down events pile up in memory, the oldest are dropped past this
+GRATITUDE_MAX_BUFFER = int(os.getenv("GRATITUDE_MAX_BUFFER", 10000))
+
+
+def memo_hash(memo):
+    return hashlib.sha1((memo or '').encode()).hexdigest()
+
+
+class GratitudeLedger:
+    """
+    Records every Gratitude sent, without making the handler wait for an INSERT
+
+    record() only appends to an in-memory buffer; a background task writes
+    the buffer with one multi-row INSERT, and adds it to the /top counters
+    in the same transaction, when it reaches batch_size or every
+    flush_interval seconds. close() writes whatever is left, call it on
+    shutdown. A failed flush puts the rows back and is retried on the next one.
+    """
+
+    def __init__(self, batch_size=GRATITUDE_BATCH_SIZE, flush_interval=GRATITUDE_FLUSH_INTERVAL,
+                 max_buffer=GRATITUDE_MAX_BUFFER):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._wakeup: typing.Optional[asyncio.Event] = None
+        self._task: typing.Optional[asyncio.Task] = None
+        self._lock: typing.Optional[asyncio.Lock] = None
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    def record(self, sender, recipient, chat, memo, esr_id=None, sender_name=None, recipient_name=None):
+        """
+        :param sender: telegram id of who sent the Gratidaum
+        :param recipient: User.pk_id of who received it
+        :param chat: chat id where /gratz was used
+        :param sender_name: shown by /top, not stored in Gratitude
+        :param recipient_name: shown by /top, not stored in Gratitude
+        """
+        self._buffer.append({
+            "sender": sender,
+            "recipient": recipient,
+            "chat": chat,
+            "memo_hash": memo_hash(memo),
+            "esr_id": esr_id,
+            "created_date": datetime.now(),
+            "sender_name": sender_name,
+            "recipient_name": recipient_name,
+        })
+        self.recorded += 1
+        self._trim()
+        if len(self._buffer) >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _trim(self):
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            del self._buffer[:overflow]
+            self.dropped += overflow
+            log.warning("Gratitude buffer full, dropped %s events", overflow)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Stop the background task and write the remaining events"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._buffer:
+            log.error("%s gratitude events could not be written", len(self._buffer))
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write the buffered events, batch_size rows per INSERT"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while self._buffer:
+                batch, self._buffer = self._buffer[:self.batch_size], self._buffer[self.batch_size:]
+                try:
+                    await run_db(self._write, batch)
+                except Exception as e:
+                    self.failed_flushes += 1
+                    log.error("Gratitude flush of %s events failed => Error %s", len(batch), e)
+                    self._buffer[:0] = batch
+                    self._trim()
+                    return
+                self.written += len(batch)
+
+    # Runs on the DB thread pool
+
+    @staticmethod
+    def _write(events):
+        columns = Gratitude._meta.fields.keys()
+        with db.atomic():
+            Gratitude.insert_many([{k: v for k, v in event.items() if k in columns} for event in events]).execute()
+            write_counters(events)
+
+    def stats(self):
+        return {
+            "buffered": len(self._buffer),
+            "recorded": self.recorded,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed_flushes": self.failed_flushes,
+        }
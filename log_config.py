@@ -0,0 +1,143 @@
+"""
+Logging setup, call setup_logging() once from the entry point
+
+    LOG_LEVEL=INFO                          root level
+    LOG_LEVELS=aiogram=WARNING,dedup=DEBUG  per-logger levels
+    LOG_FORMAT=json                         json (one object per line) or text
+    LOG_DEBUG_SAMPLE_RATE=0.1               share of updates whose DEBUG records are kept
+
+Records carry the update_id, chat_id and handler being processed, set by
+LogContextMiddleware. Debug sampling is decided per update, so a sampled
+update keeps all of its DEBUG lines.
+"""
+import json
+import logging
+import os
+import sys
+import zlib
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "aiohttp.access=WARNING,aiogram=INFO,peewee=INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 0.1))
+
+ctx_update_id: ContextVar = ContextVar("log_update_id", default=None)
+ctx_chat_id: ContextVar = ContextVar("log_chat_id", default=None)
+ctx_handler: ContextVar = ContextVar("log_handler", default=None)
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [update=%(update_id)s chat=%(chat_id)s " \
+              "handler=%(handler)s] %(message)s"
+
+_configured = False
+
+
+def parse_levels(value):
+    """'aiogram=WARNING,dedup=DEBUG' -> {'aiogram': 'WARNING', 'dedup': 'DEBUG'}"""
+    levels = {}
+    for item in (value or '').split(','):
+        name, _, level = item.strip().partition('=')
+        if name and level:
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+class ContextFilter(logging.Filter):
+    """Copies the update context into every record"""
+
+    def filter(self, record):
+        record.update_id = ctx_update_id.get()
+        record.chat_id = ctx_chat_id.get()
+        record.handler = ctx_handler.get()
+        return True
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Keeps DEBUG records of `rate` of the updates, records outside an update are kept"""
+
+    def __init__(self, rate=LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self.threshold = int(rate * 1000)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.threshold >= 1000:
+            return True
+        update_id = getattr(record, "update_id", None)
+        if update_id is None:
+            return True
+        return zlib.crc32(str(update_id).encode()) % 1000 < self.threshold
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in ("update_id", "chat_id", "handler"):
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level=LOG_LEVEL, levels=LOG_LEVELS, fmt=LOG_FORMAT, sample_rate=LOG_DEBUG_SAMPLE_RATE):
+    """Configure the root logger, later calls do nothing"""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(DebugSamplingFilter(sample_rate))
+    handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, logger_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(logger_level)
+
+
+def _chat_id(update):
+    for name in ("message", "edited_message", "channel_post", "my_chat_member", "chat_member"):
+        obj = getattr(update, name, None)
+        if obj is not None:
+            return obj.chat.id
+    if update.callback_query and update.callback_query.message:
+        return update.callback_query.message.chat.id
+    return None
+
+
+class LogContextMiddleware(BaseMiddleware):
+    """Sets update_id/chat_id/handler for every log record written while an update is processed"""
+
+    _TOKENS = "_log_context_tokens"
+
+    async def on_pre_process_update(self, update, data):
+        data[self._TOKENS] = (ctx_update_id.set(update.update_id), ctx_chat_id.set(_chat_id(update)),
+                              ctx_handler.set(None))
+
+    async def on_post_process_update(self, update, results, data):
+        tokens = data.pop(self._TOKENS, None)
+        if tokens:
+            for var, token in zip((ctx_update_id, ctx_chat_id, ctx_handler), tokens):
+                var.reset(token)
+
+    async def trigger(self, action, args):
+        await super().trigger(action, args)
+        # Errors handlers keep the name of the handler that failed
+        if action.startswith("process_") and action not in ("process_update", "process_error"):
+            handler = current_handler.get(None)
+            ctx_handler.set(getattr(handler, "__name__", None))
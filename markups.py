@@ -0,0 +1,57 @@
+"""
+Reply markups built and serialized once, at import
+
+aiogram serializes a reply_markup object to JSON on every request, but
+prepare_arg() passes strings through untouched. So each keyboard is built
+once here and only its JSON string is kept. The strings are immutable and
+shared by every handler. New keyboards are registered the same way:
+
+    CONFIRM_KEYBOARD = MARKUPS.register('confirm', build_confirm_keyboard())
+"""
+import typing
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
+from aiogram.utils.payload import prepare_arg
+
+LANGUAGES = (
+    ('🇧🇷 Português 🇧🇷', 'pt'),
+    ('🇺🇸 English 🇺🇸', 'en'),
+    ('🇪🇸 Español 🇪🇸', 'es'),
+)
+
+
+class MarkupRegistry:
+    """Name -> serialized reply markup, ready to be passed as reply_markup"""
+
+    def __init__(self):
+        self._markups: typing.Dict[str, str] = {}
+
+    def register(self, name, markup) -> str:
+        if name in self._markups:
+            raise ValueError(f"Markup '{name}' is already registered")
+        serialized = prepare_arg(markup)
+        self._markups[name] = serialized
+        return serialized
+
+    def __getitem__(self, name) -> str:
+        return self._markups[name]
+
+    def __contains__(self, name):
+        return name in self._markups
+
+    def names(self):
+        return tuple(self._markups)
+
+
+def build_language_keyboard():
+    # in real life for the callback_data the callback data factory should be used
+    # here the raw string is used for the simplicity
+    keyboard_markup = InlineKeyboardMarkup(row_width=3)
+    keyboard_markup.row(*(InlineKeyboardButton(text, callback_data=data) for text, data in LANGUAGES))
+    return keyboard_markup
+
+
+MARKUPS = MarkupRegistry()
+
+LANGUAGE_KEYBOARD = MARKUPS.register('language', build_language_keyboard())
+REMOVE_KEYBOARD = MARKUPS.register('remove_keyboard', ReplyKeyboardRemove())
@@ -0,0 +1,194 @@
+"""
+Prometheus-style counters and histograms, served as text on /metrics
+
+No client library: a handful of metrics with few label values, updated from
+the event loop and from the DB threads, hence the lock.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from log_config import ctx_handler
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_UPDATE_TYPES = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'inline_query',
+                 'chosen_inline_result', 'callback_query', 'shipping_query', 'pre_checkout_query', 'poll',
+                 'poll_answer', 'my_chat_member', 'chat_member')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), lock=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = lock or threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, lock=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = lock or threading.Lock()
+        # key -> [count per bucket..., +Inf count, sum]
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def observe(self, seconds, **labels):
+        key = self._key(labels)
+        with self._lock:
+            value = self._values.get(key)
+            if value is None:
+                value = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    value[i] += 1
+            value[-2] += 1
+            value[-1] += seconds
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, labels may be changed inside it (e.g. result)"""
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        value = self._values.get(self._key(labels))
+        return value[-2] if value else 0
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(value) for key, value in self._values.items()}
+        for key, value in sorted(values.items()):
+            for bound, count in zip(self.buckets, value):
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', bound))} {count}"
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', '+Inf'))} {value[-2]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {value[-2]}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {value[-1]}"
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = Counter(name, documentation, labelnames, lock=self._lock)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, labelnames, buckets, lock=self._lock)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Text exposition format 0.0.4"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+UPDATES = REGISTRY.counter("bot_updates_total", "Updates received, by type", ["type"])
+HANDLER_SECONDS = REGISTRY.histogram("bot_handler_seconds", "Time spent in each handler", ["handler"])
+HANDLER_ERRORS = REGISTRY.counter("bot_handler_errors_total", "Exceptions that escaped a handler",
+                                  ["handler", "error"])
+LOGGED_ERRORS = REGISTRY.counter("bot_logged_errors_total", "ERROR log records, by logger", ["logger"])
+DB_QUERY_SECONDS = REGISTRY.histogram("bot_db_query_seconds", "Postgres query time, by statement",
+                                      ["statement"])
+ESR_SECONDS = REGISTRY.histogram("bot_esr_seconds", "Signing request creation time", ["encoder", "result"])
+TELEGRAM_SECONDS = REGISTRY.histogram("bot_telegram_seconds", "Bot API call time", ["method", "result"])
+
+
+def update_type(update):
+    for name in _UPDATE_TYPES:
+        if getattr(update, name, None) is not None:
+            return name
+    return "unknown"
+
+
+def record_error(exception):
+    """Count an exception escaping a handler, see errors_handler in webhook_server"""
+    HANDLER_ERRORS.inc(handler=ctx_handler.get() or "none", error=type(exception).__name__)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Counts updates and times every handler that runs (filters excluded)"""
+
+    _STARTED = "_metrics_started"
+    _HANDLER = "_metrics_handler"
+
+    async def on_pre_process_update(self, update, data):
+        UPDATES.inc(type=update_type(update))
+
+    async def trigger(self, action, args):
+        await super().trigger(action, args)
+        if action == "process_update" or action.endswith("_error"):
+            return
+        if action.startswith("process_"):
+            handler = current_handler.get(None)
+            args[-1][self._HANDLER] = getattr(handler, "__name__", "unknown")
+            args[-1][self._STARTED] = time.perf_counter()
+        elif action.startswith("post_process_") and action != "post_process_update":
+            started = args[-1].pop(self._STARTED, None)
+            if started is not None:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, handler=args[-1].pop(self._HANDLER))
+
+
+class ErrorCountingHandler(logging.Handler):
+    """Counts ERROR records by logger, handler failures once each: only the errors handler logs them"""
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+
+    def emit(self, record):
+        LOGGED_ERRORS.inc(logger=record.name)
@@ -1,94 +1,211 @@
+import argparse
 import logging
+import sys
 
+from peewee import fn, ProgrammingError
 from playhouse.migrate import *
-from db import db, DBVersion
-from varname import nameof
+
+from db import db, DBVersion, User, FsmState, Gratitude, GratitudeCounter, GratitudeTotal, ProcessedUpdate, \
+    GratitudeWindow, GratitudeWindowState, init_db
+from log_config import setup_logging
 
 # logging.basicConfig(level=logging.INFO)
 
 log = logging.getLogger("migrate")
-current_version_db = DBVersion.select().count()
 
-log.info(f"current_version_db={current_version_db}")
+# Arbitrary constant shared by every dyno, 'grat' in ascii
+ADVISORY_LOCK_KEY = 0x67726174
+
+MIGRATIONS = {}
+
+migrator = PostgresqlMigrator(db)
+
+user_table_name = "user"
+
+
+def migration(number):
+    """
+    Register a migration under its version number
+
+    Each migration runs in its own transaction and receives the migrator.
+    """
+
+    def decorator(func):
+        if number in MIGRATIONS:
+            raise ValueError(f"Duplicated migration number {number}")
+        MIGRATIONS[number] = func
+        return func
+
+    return decorator
 
-migrator = SqliteMigrator(db)
 
+def _columns(table):
+    return {column.name for column in db.get_columns(table)}
 
-def migrate_non_stop(*operations):
-    all_completed = True
-    for ope in operations:
-        try:
-            ope.run()
-        except Exception as e:
-            all_completed = False
-            log.warning(f"Propably already updated => Error {e}")
 
-    return all_completed
+def _indexes(table):
+    return {index.name for index in db.get_indexes(table)}
 
 
-def migrate1():
-    if current_version_db > 0:
-        log.info("Already applied, ignore")
-        return
+@migration(1)
+def migrate1(migrator):
+    # Fresh database: the table only, its indexes come with migrate3 once duplicates are gone
+    User._schema.create_table(safe=True)
 
-    # user_id = CharField()
     user_id = CharField(primary_key=False, null=True)
-    pk_id1 = IntegerField()
-    pk_id2 = AutoField()
     name = CharField(primary_key=False, unique=False)
 
-    user_table_name = "user"
-    try:
-        log.info(f"We'll start migrating")
-
-        with db.atomic():
-            all_completed = migrate_non_stop(
-                migrator.drop_index(user_table_name, f"{user_table_name}_name"),
-                migrator.alter_column_type(user_table_name, nameof(name), name),
-                migrator.alter_add_column(user_table_name, nameof(user_id), user_id),
-                migrator.alter_add_column(user_table_name, "pk_id", pk_id1),
-                migrator.alter_column_type(user_table_name, "pk_id", pk_id2),
-            )
-            if all_completed:
-                log.info(f"Done migrate")
-            else:
-                log.info(f"Maybe already done that")
-            try:
-                DBVersion.create()
-            except Exception as e:
-                log.error(f"Some error try update DBVersion Table => Error {e}")
-    except Exception as e:
-        log.warning(f"Propably already updated => Error {e}")
-
-
-def migrate2():
-    if current_version_db > 1:
-        log.info("Already applied, ignore")
-        return
+    if f"{user_table_name}_name" in _indexes(user_table_name):
+        migrate(migrator.drop_index(user_table_name, f"{user_table_name}_name"))
+    migrate(migrator.alter_column_type(user_table_name, "name", name))
+
+    columns = _columns(user_table_name)
+    if "user_id" not in columns:
+        migrate(migrator.add_column(user_table_name, "user_id", user_id))
+    if "pk_id" not in columns:
+        db.execute_sql(f'ALTER TABLE "{user_table_name}" ADD COLUMN pk_id SERIAL')
+
 
+@migration(2)
+def migrate2(migrator):
     locale = CharField(null=True)
 
-    user_table_name = "user"
+    if "locale" not in _columns(user_table_name):
+        migrate(migrator.add_column(user_table_name, "locale", locale))
+
+
+@migration(3)
+def migrate3(migrator):
+    # Keep only the most recent row for each user_id before making it unique
+    cursor = db.execute_sql(
+        f'DELETE FROM "{user_table_name}" a USING "{user_table_name}" b '
+        'WHERE a.user_id IS NOT NULL AND a.user_id = b.user_id '
+        'AND (a.updated_date < b.updated_date '
+        'OR (a.updated_date = b.updated_date AND a.pk_id < b.pk_id))')
+    log.info("Removed %s duplicated users", cursor.rowcount)
+
+    db.execute_sql(f'CREATE UNIQUE INDEX IF NOT EXISTS "{user_table_name}_user_id" '
+                   f'ON "{user_table_name}" (user_id)')
+    db.execute_sql(f'CREATE INDEX IF NOT EXISTS "{user_table_name}_name_lower" '
+                   f'ON "{user_table_name}" (lower(name))')
+    db.execute_sql(f'CREATE INDEX IF NOT EXISTS "{user_table_name}_username_lower" '
+                   f'ON "{user_table_name}" (lower(username))')
+
+
+@migration(4)
+def migrate4(migrator):
+    FsmState.create_table(safe=True)
+
+
+@migration(5)
+def migrate5(migrator):
+    Gratitude.create_table(safe=True)
+
+
+@migration(6)
+def migrate6(migrator):
+    GratitudeCounter.create_table(safe=True)
+    GratitudeTotal.create_table(safe=True)
+
+    # Backfill from the events recorded so far, sender names are only known from now on
+    db.execute_sql(
+        'INSERT INTO gratitude_counter (chat, day, role, member, name, count) '
+        "SELECT chat, created_date::date, 'given', sender, NULL, count(*) FROM gratitude "
+        'GROUP BY chat, created_date::date, sender '
+        'UNION ALL '
+        "SELECT g.chat, g.created_date::date, 'received', g.recipient, max(u.name), count(*) FROM gratitude g "
+        f'LEFT JOIN "{user_table_name}" u ON u.pk_id = g.recipient '
+        'GROUP BY g.chat, g.created_date::date, g.recipient '
+        'UNION ALL '
+        "SELECT chat, created_date::date, 'chat', 0, NULL, count(*) FROM gratitude "
+        'GROUP BY chat, created_date::date '
+        'ON CONFLICT DO NOTHING')
+    db.execute_sql(
+        'INSERT INTO gratitude_total (chat, role, member, name, count) '
+        'SELECT chat, role, member, max(name), sum(count) FROM gratitude_counter '
+        'GROUP BY chat, role, member '
+        'ON CONFLICT DO NOTHING')
+
+
+@migration(7)
+def migrate7(migrator):
+    ProcessedUpdate.create_table(safe=True)
+
+
+@migration(8)
+def migrate8(migrator):
+    # Windows are filled by gratitude_stats.roll_windows on the first start
+    GratitudeWindow.create_table(safe=True)
+    GratitudeWindowState.create_table(safe=True)
+    # (chat, role, count) for the all-time ranking
+    GratitudeTotal._schema.create_indexes(safe=True)
+
+
+def head():
+    return max(MIGRATIONS) if MIGRATIONS else 0
+
+
+def current_version():
+    """Single indexed query (max of the primary key), 0 on a database never migrated"""
+    try:
+        return DBVersion.select(fn.MAX(DBVersion.number)).scalar() or 0
+    except ProgrammingError:
+        # No dbversion table yet, run_migrations creates it
+        return 0
+
+
+def is_at_head():
+    return current_version() >= head()
+
+
+def run_migrations():
+    """
+    Apply every pending migration, in order
+
+    An advisory lock serializes concurrent dynos; the version is read again
+    after taking it, so the loser of the race just sees head and returns.
+    """
+    if is_at_head():
+        log.info("Database already at head=%s", head())
+        return current_version()
 
+    db.execute_sql("SELECT pg_advisory_lock(%s)", (ADVISORY_LOCK_KEY,))
     try:
-        log.info(f"We'll start migrating")
-
-        with db.atomic():
-            all_completed = migrate_non_stop(
-                migrator.alter_add_column(user_table_name, nameof(locale), locale),
-            )
-            if all_completed:
-                log.info(f"Done migrate")
-                try:
-                    DBVersion.create()
-                except Exception as e:
-                    log.error(f"Some error try update DBVersion Table => Error {e}")
-            else:
-                log.info(f"Maybe already done that")
-    except Exception as e:
-        log.warning(f"Propably already updated => Error {e}")
-
-
-def start_migration():
-    migrate1()
-    migrate2()
+        DBVersion.create_table(safe=True)
+        version = current_version()
+        log.info("current_version_db=%s head=%s", version, head())
+        for number in sorted(MIGRATIONS):
+            if number <= version:
+                continue
+            log.info("Applying migration %s: %s", number, MIGRATIONS[number].__name__)
+            with db.atomic():
+                MIGRATIONS[number](migrator)
+                DBVersion.create(number=number)
+            version = number
+        log.info("Done migrate, version=%s", version)
+        return version
+    finally:
+        db.execute_sql("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_KEY,))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Seeds Gratidaum Bot database migrations")
+    parser.add_argument("--status", action="store_true", help="only show the current and head versions")
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    # The schema comes from the migrations only, create_tables would build the unique
+    # user_id index before migrate3 removes the duplicates
+    init_db(create_tables=False)
+
+    if args.status:
+        version = current_version()
+        print(f"current={version} head={head()}")
+        return 0 if version >= head() else 1
+
+    run_migrations()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
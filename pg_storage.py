@@ -0,0 +1,205 @@
+import asyncio
+import json
+import logging
+import os
+import typing
+from datetime import datetime, timedelta
+
+from aiogram.dispatcher.storage import BaseStorage
+from peewee import Tuple
+
+from cache import TTLCache, MISSING
+from db import FsmState
+from repository import run_db
+
+log = logging.getLogger("pg_storage")
+
+# Abandoned conversations (e.g. /start without answering) expire after this
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 24 * 60 * 60))
+FSM_CLEANUP_INTERVAL = int(os.getenv("FSM_CLEANUP_INTERVAL", 10 * 60))
+FSM_CLEANUP_BATCH = int(os.getenv("FSM_CLEANUP_BATCH", 500))
+# How long a (chat, user) known to have no state is answered without a query. A
+# state written by another dyno is only seen after it, use 0 to disable.
+FSM_NO_STATE_TTL = float(os.getenv("FSM_NO_STATE_TTL", 60))
+FSM_NO_STATE_CACHE_SIZE = int(os.getenv("FSM_NO_STATE_CACHE_SIZE", 10000))
+
+
+class PostgresStorage(BaseStorage):
+    """
+    FSM storage in the bot's own Postgres database.
+
+    One row per (chat, user), deleted as soon as the conversation finishes, so
+    the table only holds conversations in progress. Every process/dyno sees the
+    same states and they survive restarts. Rows older than ttl are ignored on
+    read and removed in batches by a background task.
+
+    Most updates (/help, inline queries, group messages) come from users with
+    no conversation in progress, so those (chat, user) are remembered for
+    no_state_ttl and their state is resolved without a round-trip. Every write
+    forgets the key.
+    """
+
+    def __init__(self, ttl=FSM_STATE_TTL, cleanup_interval=FSM_CLEANUP_INTERVAL, cleanup_batch=FSM_CLEANUP_BATCH,
+                 no_state_ttl=FSM_NO_STATE_TTL, no_state_cache_size=FSM_NO_STATE_CACHE_SIZE):
+        self.ttl = timedelta(seconds=ttl)
+        self.cleanup_interval = cleanup_interval
+        self.cleanup_batch = cleanup_batch
+        self.no_state = TTLCache(maxsize=no_state_cache_size, ttl=no_state_ttl)
+        # Bumped by every write, a read that overlapped one does not fill the cache
+        self._writes = 0
+        self._cleanup_task: typing.Optional[asyncio.Task] = None
+
+    def start_cleanup(self):
+        if self._cleanup_task is None or self._cleanup_task.done():
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self):
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+
+    async def wait_closed(self):
+        if self._cleanup_task is not None:
+            try:
+                await self._cleanup_task
+            except asyncio.CancelledError:
+                pass
+            self._cleanup_task = None
+
+    # Sync helpers, they run on the DB thread pool
+
+    def _expired_before(self):
+        return datetime.now() - self.ttl
+
+    def _read(self, chat, user):
+        row = (FsmState
+               .select(FsmState.state, FsmState.data)
+               .where((FsmState.chat == chat) & (FsmState.user == user)
+                      & (FsmState.updated_date > self._expired_before()))
+               .first())
+        if row is None:
+            return None, {}
+        return row.state, json.loads(row.data)
+
+    def _write(self, chat, user, state, data):
+        if state is None and not data:
+            FsmState.delete().where((FsmState.chat == chat) & (FsmState.user == user)).execute()
+            return
+        (FsmState
+         .insert(chat=chat, user=user, state=state,
+                 data=json.dumps(data, separators=(',', ':'), ensure_ascii=False),
+                 updated_date=datetime.now())
+         .on_conflict(conflict_target=[FsmState.chat, FsmState.user],
+                      preserve=[FsmState.state, FsmState.data, FsmState.updated_date])
+         .execute())
+
+    def _set_state(self, chat, user, state):
+        _, data = self._read(chat, user)
+        self._write(chat, user, state, data)
+
+    def _set_data(self, chat, user, data):
+        state, _ = self._read(chat, user)
+        self._write(chat, user, state, data)
+
+    def _update_data(self, chat, user, data):
+        state, current = self._read(chat, user)
+        current.update(data)
+        self._write(chat, user, state, current)
+
+    def _delete_expired(self):
+        expired = (FsmState
+                   .select(FsmState.chat, FsmState.user)
+                   .where(FsmState.updated_date <= self._expired_before())
+                   .limit(self.cleanup_batch))
+        return (FsmState
+                .delete()
+                .where(Tuple(FsmState.chat, FsmState.user).in_(expired))
+                .execute())
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                removed = await self.cleanup()
+                if removed:
+                    log.info("Removed %s expired FSM states", removed)
+            except Exception as e:
+                log.error("FSM cleanup failed => Error %s", e)
+
+    async def cleanup(self):
+        """Delete expired states in batches of cleanup_batch rows"""
+        total = 0
+        while True:
+            removed = await run_db(self._delete_expired)
+            total += removed
+            if removed < self.cleanup_batch:
+                return total
+
+    async def _get(self, chat, user):
+        if self.no_state.get((chat, user)) is not MISSING:
+            return None, {}
+        writes = self._writes
+        state, data = await run_db(self._read, chat, user)
+        if state is None and not data and writes == self._writes:
+            self.no_state.set((chat, user), True)
+        return state, data
+
+    async def _run_write(self, func, chat, user, *args):
+        self._writes += 1
+        try:
+            await run_db(func, chat, user, *args)
+        finally:
+            self._writes += 1
+            self.no_state.invalidate((chat, user))
+
+    def stats(self):
+        return self.no_state.stats()
+
+    # BaseStorage API
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        chat, user = map(int, self.check_address(chat=chat, user=user))
+        state, _ = await self._get(chat, user)
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        chat, user = map(int, self.check_address(chat=chat, user=user))
+        _, data = await self._get(chat, user)
+        return data if data else (default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.Optional[typing.AnyStr] = None):
+        chat, user = map(int, self.check_address(chat=chat, user=user))
+        await self._run_write(self._set_state, chat, user, self.resolve_state(state))
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        chat, user = map(int, self.check_address(chat=chat, user=user))
+        await self._run_write(self._set_data, chat, user, data or {})
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        chat, user = map(int, self.check_address(chat=chat, user=user))
+        await self._run_write(self._update_data, chat, user, dict(data or {}, **kwargs))
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        if with_data:
+            chat, user = map(int, self.check_address(chat=chat, user=user))
+            await self._run_write(self._write, chat, user, None, {})
+        else:
+            await self.set_state(chat=chat, user=user, state=None)
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import os
+import typing
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.utils.exceptions import ConflictError
+
+from update_queue import UpdateQueue
+
+log = logging.getLogger("polling")
+
+POLLING_WORKERS = int(os.getenv("POLLING_WORKERS", 8))
+POLLING_LIMIT = int(os.getenv("POLLING_LIMIT", 100))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 25))
+POLLING_ERROR_SLEEP = float(os.getenv("POLLING_ERROR_SLEEP", 5))
+# 1: the offset only moves past a batch once every update in it was processed,
+# 0: as soon as the batch is queued, faster but a crash loses what was queued
+POLLING_WAIT_PROCESSED = os.getenv("POLLING_WAIT_PROCESSED", "1") == "1"
+
+
+class PollingWorker:
+    """
+    getUpdates loop feeding an UpdateQueue
+
+    Telegram considers a batch delivered when getUpdates is called again with
+    an offset past it, so the offset is committed once per batch, never per
+    update. Updates of a batch are processed concurrently by the queue's
+    workers, still in order within a chat. stop() commits the last batch, so
+    a restart does not receive it again. A Conflict from Telegram (a webhook
+    was set or another poller started) stops the worker instead of fighting
+    over the updates.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, queue: UpdateQueue, dedup=None, limit=POLLING_LIMIT,
+                 timeout=POLLING_TIMEOUT, wait_processed=POLLING_WAIT_PROCESSED, error_sleep=POLLING_ERROR_SLEEP):
+        self.dispatcher = dispatcher
+        self.bot: Bot = dispatcher.bot
+        self.queue = queue
+        self.dedup = dedup
+        self.limit = limit
+        self.timeout = timeout
+        self.wait_processed = wait_processed
+        self.error_sleep = error_sleep
+        self.offset = None
+        self._running = False
+        self._fetch: typing.Optional[asyncio.Future] = None
+        self.batches = 0
+        self.received = 0
+        self.errors = 0
+
+    async def _get_updates(self):
+        # The HTTP request must outlive the long poll itself
+        with self.bot.request_timeout(aiohttp.ClientTimeout(total=self.timeout + 10)):
+            return await self.bot.get_updates(offset=self.offset, limit=self.limit, timeout=self.timeout)
+
+    async def commit(self):
+        """Confirm everything before self.offset without waiting for new updates"""
+        if self.offset is not None:
+            await self.bot.get_updates(offset=self.offset, limit=1, timeout=0)
+
+    async def run(self):
+        Dispatcher.set_current(self.dispatcher)
+        Bot.set_current(self.bot)
+        self.queue.start()
+        self._running = True
+        log.info("Polling with %s workers", self.queue.workers)
+        try:
+            while self._running:
+                self._fetch = asyncio.ensure_future(self._get_updates())
+                try:
+                    updates = await self._fetch
+                except asyncio.CancelledError:
+                    if self._running:
+                        raise
+                    break
+                except ConflictError as e:
+                    log.error("Another consumer owns the updates, stopping => Error %s", e)
+                    self._running = False
+                    break
+                except Exception as e:
+                    self.errors += 1
+                    log.error("getUpdates failed => Error %s", e)
+                    await asyncio.sleep(self.error_sleep)
+                    continue
+                finally:
+                    self._fetch = None
+
+                if not updates:
+                    continue
+                self.batches += 1
+                self.received += len(updates)
+                for update in updates:
+                    if self.dedup is None or await self.dedup.claim(update.update_id):
+                        await self.queue.put(update)
+                if self.wait_processed:
+                    await self.queue.join()
+                self.offset = updates[-1].update_id + 1
+        finally:
+            await self.queue.stop(drain=True)
+            try:
+                await self.commit()
+            except Exception as e:
+                log.error("Could not commit offset %s => Error %s", self.offset, e)
+            log.info("Polling stopped: %s", self.stats())
+
+    def stop(self):
+        """Finish the batch in progress and leave run(), safe to call from a signal handler"""
+        self._running = False
+        if self._fetch is not None:
+            self._fetch.cancel()
+
+    def stats(self):
+        return {
+            "offset": self.offset,
+            "batches": self.batches,
+            "received": self.received,
+            "errors": self.errors,
+            "queue": self.queue.stats(),
+        }
@@ -0,0 +1,69 @@
+"""
+Runs the bot with getUpdates long polling instead of the webhook
+
+    python3 polling_worker.py
+
+No public URL needed, so it works behind NAT and is the fallback when the
+webhook path is degraded. It replaces the web process, it never runs next
+to it: Telegram delivers either to the webhook or to getUpdates. That is
+why it is not in the Procfile. To switch on Heroku, scale web to 0 (its
+shutdown deletes the webhook) and run this as a one-off or worker dyno.
+
+While a webhook is set the worker refuses to start, POLLING_TAKEOVER=1
+deletes it anyway (a web dyno that died without cleaning up). If web
+starts again later, its webhook makes getUpdates fail with Conflict and the
+worker exits.
+"""
+import asyncio
+import logging
+import os
+import signal
+import sys
+
+from aiogram import Bot, Dispatcher
+
+from polling import PollingWorker, POLLING_WORKERS
+from update_queue import UpdateQueue
+from webhook_server import bot, dp, update_dedup, start_services, stop_services, startup_report
+
+POLLING_SKIP_UPDATES = os.getenv("POLLING_SKIP_UPDATES", "0") == "1"
+POLLING_TAKEOVER = os.getenv("POLLING_TAKEOVER", "0") == "1"
+
+
+async def main():
+    logging.warning('Startup polling..')
+    # start_services() already needs them for the deep links, on web the Executor sets them
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    webhook = await bot.get_webhook_info()
+    if webhook.url and not POLLING_TAKEOVER:
+        logging.error("Webhook %s is set, the web process is running. Scale it to 0 first "
+                      "or set POLLING_TAKEOVER=1", webhook.url)
+        session = await bot.get_session()
+        await session.close()
+        return 1
+
+    await start_services()
+    with startup_report.phase("webhook"):
+        await bot.delete_webhook()
+    if POLLING_SKIP_UPDATES:
+        await dp.skip_updates()
+
+    worker = PollingWorker(dp, UpdateQueue(dp, workers=POLLING_WORKERS), dedup=update_dedup)
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, worker.stop)
+    startup_report.log()
+
+    try:
+        await worker.run()
+    finally:
+        logging.warning('Shutting down..')
+        await stop_services()
+        session = await bot.get_session()
+        await session.close()
+        logging.warning('Bye!')
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
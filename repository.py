@@ -0,0 +1,130 @@
+import asyncio
+import functools
+import logging
+import operator
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from peewee import fn, InterfaceError, OperationalError
+
+from db import db, User
+
+log = logging.getLogger("repository")
+
+# Each worker thread keeps its own peewee connection, so this is also the
+# upper bound of Postgres connections opened by the bot.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+
+def _with_connection(func, *args, **kwargs):
+    db.connect(reuse_if_open=True)
+    try:
+        return func(*args, **kwargs)
+    except (InterfaceError, OperationalError) as e:
+        # Postgres dropped this thread's connection (restart, idle timeout...). Only this
+        # thread can close it, otherwise reuse_if_open keeps handing out the dead one.
+        log.warning("Database connection lost, reconnecting => Error %s", e)
+        db.close()
+        db.connect()
+        return func(*args, **kwargs)
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Run a blocking peewee call on the bounded DB thread pool
+
+    A call failing on a broken connection is run once more on a new one, so
+    func must be safe to repeat (its writes in one transaction, or upserts).
+
+    :param func: sync callable doing the queries
+    :return: whatever func returns
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(_with_connection, func, *args, **kwargs))
+
+
+def shutdown():
+    _executor.shutdown(wait=True)
+
+
+class UserRepository:
+    """Async access to the User table. Every query runs on the DB thread pool."""
+
+    async def get_by_telegram_id(self, user_id):
+        return await run_db(User.get_or_none, user_id=user_id)
+
+    async def get_by_name(self, name):
+        return await run_db(User.get_or_none, fn.lower(User.name) == name.lower())
+
+    async def get_many(self, user_ids, names):
+        """Every user matching one of the telegram ids or (case-insensitive) names, in one query"""
+        return await run_db(self._get_many, user_ids, names)
+
+    async def set_locale(self, user_id, name, username, locale):
+        return await run_db(self._set_locale, user_id, name, username, locale)
+
+    async def upsert_username(self, user_id, name, username):
+        return await run_db(self._upsert_username, user_id, name, username)
+
+    @staticmethod
+    def _get_many(user_ids, names):
+        clauses = []
+        if user_ids:
+            clauses.append(User.user_id.in_([str(user_id) for user_id in user_ids]))
+        if names:
+            clauses.append(fn.lower(User.name).in_([name.lower() for name in names]))
+        if not clauses:
+            return []
+        return list(User.select().where(functools.reduce(operator.or_, clauses)))
+
+    @staticmethod
+    def _set_locale(user_id, name, username, locale):
+        user = User.get_or_none(user_id=user_id)
+        if not user:
+            log.info("Creating from user id: %s", user_id)
+            user = User.create(
+                user_id=user_id,
+                name=name,
+                username=username,
+                created_date=datetime.now(),
+                updated_date=datetime.now(),
+            )
+        user.locale = locale
+        user.save()
+        return user
+
+    @staticmethod
+    def _upsert_username(user_id, name, username):
+        with db.atomic():
+            user = User.get_or_none(user_id=user_id)
+            if user:
+                user.username = username
+                user.name = name
+                user.updated_date = datetime.now()
+                user.save()
+                log.info(" user updated by user_id %s", user.pk_id)
+                return user
+
+            user = User.get_or_none(fn.lower(User.name) == name.lower())
+            if user:
+                user.username = username
+                user.user_id = user_id
+                user.updated_date = datetime.now()
+                user.save()
+                log.info(" user updated by name %s", user.pk_id)
+                return user
+
+            user = User.create(
+                name=name,
+                username=username,
+                user_id=user_id,
+                created_date=datetime.now(),
+                updated_date=datetime.now())
+            log.info("UserID upserted: %s", user.pk_id)
+            return user
+
+
+users = UserRepository()
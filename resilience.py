@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+log = logging.getLogger("resilience")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Classic closed -> open -> half-open breaker.
+
+    After failure_threshold consecutive failed calls it opens and rejects
+    everything for reset_timeout seconds, then lets a single probe through.
+    A probe that never reports back (abandon() was not reached either) stops
+    blocking after another reset_timeout, so the breaker cannot stay stuck.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = 0.0
+        self.rejected = 0
+
+    def allow(self):
+        if self.state == self.OPEN:
+            if self._clock() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self.probe_started_at = self._clock()
+            return True
+        if self.state == self.HALF_OPEN:
+            # Only the probe already in flight is allowed
+            if self._clock() - self.probe_started_at < self.reset_timeout:
+                self.rejected += 1
+                return False
+            log.warning("Circuit probe never finished, sending a new one")
+            self.probe_started_at = self._clock()
+            return True
+        return True
+
+    def abandon(self):
+        """The call allowed last ended without a result (cancelled), a new probe may go right away"""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                log.warning("Circuit opened after %s failures", self.failures)
+            self.state = self.OPEN
+            self.opened_at = self._clock()
+
+
+class LatencyWindow:
+    """Last N successful latencies, to know when a request is already slow"""
+
+    def __init__(self, size=100):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def percentile(self, p):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+class ResilientCall:
+    """
+    Wraps an idempotent async call with deadlines, retries, hedging and a breaker
+
+    :param attempts: max attempts per call
+    :param attempt_timeout: seconds allowed for each attempt
+    :param deadline: seconds allowed for the whole call, retries included
+    :param backoff: base of the exponential full-jitter backoff between attempts
+    :param hedge_percentile: start a second request when the first is slower than
+        this percentile of recent latencies (0 disables hedging)
+    :param retry_on: exception types worth retrying
+    """
+
+    def __init__(self, attempts=3, attempt_timeout=3.0, deadline=8.0, backoff=0.2,
+                 hedge_percentile=0.95, hedge_min_samples=20, breaker=None,
+                 retry_on=(asyncio.TimeoutError,)):
+        self.attempts = attempts
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.backoff = backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker if breaker else CircuitBreaker()
+        self.retry_on = tuple(retry_on) + (asyncio.TimeoutError,)
+        self.latencies = LatencyWindow()
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.failures = 0
+
+    def _hedge_after(self):
+        if not self.hedge_percentile or len(self.latencies) < self.hedge_min_samples:
+            return None
+        return self.latencies.percentile(self.hedge_percentile)
+
+    async def _attempt(self, factory):
+        started = time.perf_counter()
+        tasks = [asyncio.ensure_future(factory())]
+        try:
+            hedge_after = self._hedge_after()
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    self.hedges += 1
+                    tasks.append(asyncio.ensure_future(factory()))
+
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.latencies.add(time.perf_counter() - started)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def call(self, factory):
+        """
+        :param factory: no-arg callable returning a new awaitable for each attempt
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError("circuit open")
+
+        self.calls += 1
+        settled = False
+        try:
+            deadline = time.monotonic() + self.deadline
+            error = None
+            for attempt in range(self.attempts):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if attempt:
+                    self.retries += 1
+                try:
+                    result = await asyncio.wait_for(self._attempt(factory), min(self.attempt_timeout, remaining))
+                    settled = True
+                    self.breaker.record_success()
+                    return result
+                except self.retry_on as e:
+                    error = e
+                    log.warning("Attempt %s/%s failed => Error %r", attempt + 1, self.attempts, e)
+                except Exception:
+                    settled = True
+                    self.failures += 1
+                    self.breaker.record_failure()
+                    raise
+
+                sleep = random.uniform(0, self.backoff * 2 ** attempt)
+                await asyncio.sleep(max(0.0, min(sleep, deadline - time.monotonic())))
+
+            settled = True
+            self.failures += 1
+            self.breaker.record_failure()
+            raise error if error else asyncio.TimeoutError("deadline exceeded")
+        finally:
+            # CancelledError is not an Exception, a cancelled probe must not leave the breaker half open
+            if not settled:
+                self.breaker.abandon()
+
+    def stats(self):
+        return {
+            "state": self.breaker.state,
+            "calls": self.calls,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "failures": self.failures,
+            "rejected": self.breaker.rejected,
+            "p95": self.latencies.percentile(0.95),
+        }
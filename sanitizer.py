@@ -0,0 +1,45 @@
+import html
+import os
+import re
+
+# gratz.seeds keeps the memo on-chain, longer memos are cut at this many UTF-8 bytes
+MEMO_MAX_BYTES = int(os.getenv("MEMO_MAX_BYTES", 256))
+
+_TAG_RE = re.compile(r"<!--.*?-->|<[^<>]*>", re.S)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def strip_tags(text):
+    """Drop tags and decode entities, like lxml's text_content() but without building a tree"""
+    if not text:
+        return ''
+    if '<' in text:
+        text = _TAG_RE.sub('', text)
+    if '&' in text:
+        text = html.unescape(text)
+    return text
+
+
+def truncate_utf8(text, max_bytes):
+    encoded = text.encode('utf-8')
+    if len(encoded) <= max_bytes:
+        return text
+    # 'ignore' drops a multi-byte character cut in half at the end
+    return encoded[:max_bytes].decode('utf-8', 'ignore').rstrip()
+
+
+def sanitize_memo(text, max_bytes=MEMO_MAX_BYTES):
+    """
+    Plain text memo ready to go on-chain
+
+    Tags and entities removed, whitespace collapsed and at most max_bytes long.
+    Empty or whitespace-only input gives ''.
+    """
+    text = strip_tags(text)
+    text = _SPACE_RE.sub(' ', text).strip()
+    return truncate_utf8(text, max_bytes)
+
+
+def escape_html(text):
+    """Escape user text before putting it in a ParseMode.HTML message"""
+    return html.escape(text, quote=False) if text else ''
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from aiogram import Bot, types
+from aiogram.utils.exceptions import RetryAfter
+
+from metrics import TELEGRAM_SECONDS
+
+log = logging.getLogger("send_scheduler")
+
+# Telegram limits: ~30 msg/s overall, ~1 msg/s per private chat, 20 msg/min per group
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))
+SEND_PRIVATE_RATE = float(os.getenv("SEND_PRIVATE_RATE", 1))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", 20 / 60))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", 3))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 3))
+SEND_MAX_CHATS = int(os.getenv("SEND_MAX_CHATS", 10000))
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations.
+
+    reserve() takes a token right away (the balance may go negative) and
+    returns how long the caller must wait before using it, so concurrent
+    callers queue up fairly without any lock.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def reserve(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def penalize(self, seconds):
+        """Telegram asked us to back off, push every next reservation further"""
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self.updated = self._clock()
+
+
+class SendScheduler:
+    """
+    Every outbound Bot API message goes through here.
+
+    Sends wait for a token from the global bucket and from their chat bucket,
+    RetryAfter (flood control) pushes back both buckets and is retried after
+    the time Telegram asks for, and latency/throttling are counted for stats().
+    """
+
+    def __init__(self, bot: Bot, global_rate=SEND_GLOBAL_RATE, private_rate=SEND_PRIVATE_RATE,
+                 group_rate=SEND_GROUP_RATE, chat_burst=SEND_CHAT_BURST, max_retries=SEND_MAX_RETRIES,
+                 max_chats=SEND_MAX_CHATS):
+        self.bot = bot
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def _chat_bucket(self, chat_id):
+        # Keyed by str: chat_id may be an int, a numeric str or a @channel username
+        key = str(chat_id)
+        bucket = self._chats.get(key)
+        if bucket is None:
+            # Only private chats have positive ids, groups and channels are negative or @username
+            rate = self.private_rate if key.isdigit() else self.group_rate
+            bucket = self._chats[key] = TokenBucket(rate, self.chat_burst)
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(key)
+        return bucket
+
+    async def _wait_turn(self, chat_id):
+        wait = max(self._global.reserve(), self._chat_bucket(chat_id).reserve())
+        if wait > 0:
+            self.throttled += 1
+            self.throttled_seconds += wait
+            await asyncio.sleep(wait)
+
+    async def call(self, chat_id, method, *args, **kwargs):
+        """
+        Rate limit and run one Bot API call targeting chat_id
+
+        :param chat_id: chat that receives the message, used for the per-chat bucket
+        :param method: bound Bot method, e.g. bot.send_message
+        """
+        attempt = 0
+        while True:
+            await self._wait_turn(chat_id)
+            started = time.perf_counter()
+            try:
+                result = await method(*args, **kwargs)
+            except RetryAfter as e:
+                TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=method.__name__, result="retry_after")
+                attempt += 1
+                self.retried += 1
+                # Flood control is also bot-wide, other chats must slow down as well
+                self._chat_bucket(chat_id).penalize(e.timeout)
+                self._global.penalize(e.timeout)
+                if attempt > self.max_retries:
+                    self.failed += 1
+                    raise
+                log.warning("Flood control on chat %s, retrying in %ss", chat_id, e.timeout)
+                continue
+            except Exception as e:
+                TELEGRAM_SECONDS.observe(time.perf_counter() - started, method=method.__name__,
+                                         result=type(e).__name__)
+                self.failed += 1
+                raise
+            elapsed = time.perf_counter() - started
+            TELEGRAM_SECONDS.observe(elapsed, method=method.__name__, result="ok")
+            self.sent += 1
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+            return result
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.call(chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        return await self.call(chat_id, self.bot.send_photo, chat_id, photo, **kwargs)
+
+    async def reply(self, message: types.Message, text, **kwargs):
+        return await self.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return await self.call(chat_id, self.bot.edit_message_text, text=text, chat_id=chat_id,
+                               message_id=message_id, **kwargs)
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retry_after": self.retried,
+            "throttled": self.throttled,
+            "throttled_seconds": round(self.throttled_seconds, 3),
+            "latency_avg": round(self.latency_total / self.sent, 4) if self.sent else 0.0,
+            "latency_max": round(self.latency_max, 4),
+            "chats": len(self._chats),
+        }
@@ -0,0 +1,179 @@
+"""
+Translated message templates, split once and rendered with a join
+
+A Template is a translated msgid parsed with string.Formatter into literal
+chunks and {field} slots; render() only fills the slots. bind() turns slots
+whose value never changes (links, footers) into literal text, so per request
+only the user-specific fields are left.
+
+load_translations() reads locales/<domain>.json, the msgid -> msgstr lookup
+written by i18n_build.py, so no catalog is parsed at startup or on the
+first request. Locales missing from it fall back to their compiled .mo.
+The i18n middleware loads them once and TemplateCatalog shares its copy.
+"""
+import gettext
+import json
+import logging
+import os
+import string
+
+log = logging.getLogger("templates")
+
+_formatter = string.Formatter()
+
+
+def N_(message):
+    """Marks a msgid for extraction without translating it, the Template does that per locale"""
+    return message
+
+
+class LookupTranslations(gettext.NullTranslations):
+    """gettext over a plain dict, plurals stored as 'singular\\x00plural' -> [forms...]"""
+
+    def __init__(self, messages, plural='(n != 1)'):
+        super().__init__()
+        self._catalog = messages
+        self.plural = gettext.c2py(plural)
+
+    def gettext(self, message):
+        translated = self._catalog.get(message)
+        if translated is None:
+            return self._fallback.gettext(message) if self._fallback else message
+        return translated
+
+    def ngettext(self, msgid1, msgid2, n):
+        forms = self._catalog.get(msgid1 + '\x00' + msgid2)
+        if forms is None:
+            if self._fallback:
+                return self._fallback.ngettext(msgid1, msgid2, n)
+            return msgid1 if n == 1 else msgid2
+        return forms[min(self.plural(n), len(forms) - 1)]
+
+
+def load_translations(path, domain):
+    """Every locale's translations, from the build's lookup artifact or the compiled .mo files"""
+    translations = {}
+    artifact = os.path.join(path, domain + '.json')
+    if os.path.exists(artifact):
+        with open(artifact, encoding='utf-8') as fp:
+            for locale, catalog in json.load(fp).items():
+                translations[locale] = LookupTranslations(catalog['messages'], catalog['plural'])
+
+    for name in sorted(os.listdir(path)):
+        mo_path = os.path.join(path, name, 'LC_MESSAGES', domain + '.mo')
+        if name not in translations and os.path.exists(mo_path):
+            log.warning("Locale %s is not in %s, loading %s", name, artifact, mo_path)
+            with open(mo_path, 'rb') as fp:
+                translations[name] = gettext.GNUTranslations(fp)
+
+    log.info("Loaded catalogs: %s", ', '.join(sorted(translations)) or 'none')
+    return translations
+
+
+class Template:
+    __slots__ = ('_chunks', '_slots')
+
+    def __init__(self, text=None, chunks=None, slots=None):
+        if text is not None:
+            chunks, slots = [], []
+            for literal, field, spec, conversion in _formatter.parse(text):
+                if literal:
+                    chunks.append(literal)
+                if field is not None:
+                    slots.append((len(chunks), field, spec or '', conversion))
+                    chunks.append(None)
+        self._chunks = tuple(chunks)
+        self._slots = tuple(slots)
+
+    @property
+    def fields(self):
+        return {field for _index, field, _spec, _conversion in self._slots}
+
+    @staticmethod
+    def _value(value, spec, conversion):
+        if conversion == 'r':
+            value = repr(value)
+        elif conversion == 'a':
+            value = ascii(value)
+        return format(value, spec) if spec or not isinstance(value, str) else value
+
+    def render(self, **values):
+        """Same result as text.format(**values), KeyError for a missing field"""
+        if not self._slots:
+            return ''.join(self._chunks)
+        chunks = list(self._chunks)
+        for index, field, spec, conversion in self._slots:
+            chunks[index] = self._value(values[field], spec, conversion)
+        return ''.join(chunks)
+
+    def bind(self, **values):
+        """New Template with these fields rendered into the literal text"""
+        slot_at = {slot[0]: slot for slot in self._slots}
+        chunks, slots, literal = [], [], []
+        for index, chunk in enumerate(self._chunks):
+            slot = slot_at.get(index)
+            if slot is None:
+                literal.append(chunk)
+            elif slot[1] in values:
+                literal.append(self._value(values[slot[1]], slot[2], slot[3]))
+            else:
+                if literal:
+                    chunks.append(''.join(literal))
+                    literal = []
+                slots.append((len(chunks),) + slot[1:])
+                chunks.append(None)
+        if literal:
+            chunks.append(''.join(literal))
+        return Template(chunks=chunks, slots=slots)
+
+    def __repr__(self):
+        return f"Template(fields={sorted(self.fields)!r})"
+
+
+class TemplateCatalog:
+    """
+    The Templates built from the i18n middleware's translations
+
+    The catalogs are the ones the middleware already loaded (its .locales),
+    not a second copy, and a reload() there drops the Templates split from
+    the old ones. Locales without a catalog (the source language, Portuguese)
+    render the msgid itself, like gettext does.
+    """
+
+    def __init__(self, i18n):
+        self.i18n = i18n
+        self._loaded = None
+        self._templates = {}
+
+    @property
+    def translations(self):
+        translations = self.i18n.locales
+        if translations is not self._loaded:
+            self._templates = {}
+            self._loaded = translations
+        return translations
+
+    @property
+    def locales(self):
+        return tuple(self.translations)
+
+    def text(self, msgid, locale=None):
+        translator = self.translations.get(locale)
+        return translator.gettext(msgid) if translator else msgid
+
+    def get(self, msgid, locale=None) -> Template:
+        # translations first, it may clear _templates
+        key = (locale if locale in self.translations else None, msgid)
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = Template(self.text(msgid, key[0]))
+        return template
+
+    def preload(self, *msgids):
+        """Split these templates for every locale now instead of on the first request"""
+        for locale in (None,) + self.locales:
+            for msgid in msgids:
+                self.get(msgid, locale)
+
+    def render(self, msgid, locale=None, **values):
+        return self.get(msgid, locale).render(**values)
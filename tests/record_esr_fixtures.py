@@ -0,0 +1,43 @@
+"""
+Record the Hypha ESR service's answers for test_esr_encoder
+
+    python3 -m tests.record_esr_fixtures
+
+Writes tests/fixtures/esr_remote.json, needs network access to ESR_URL.
+"""
+import json
+import sys
+import urllib.request
+from pathlib import Path
+
+from api import ESR_URL, build_acknowledge
+
+FIXTURE = Path(__file__).resolve().parent / 'fixtures' / 'esr_remote.json'
+
+CASES = (
+    ("felipenseeds", ""),
+    ("felipenseeds", "Obrigado pela ajuda!"),
+    ("gratz.seeds", "acentuação, emoji 🙏 e <b>html</b>"),
+    ("a", "x" * 300),
+    (["felipenseeds", "maria1234511"], "Valeu, time"),
+)
+
+
+def record(url=ESR_URL):
+    fixtures = []
+    for account, memo in CASES:
+        request = build_acknowledge(account, memo)
+        http_request = urllib.request.Request(url, data=json.dumps(request).encode('utf-8'),
+                                              headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(http_request, timeout=30) as response:
+            body = json.load(response)
+        fixtures.append({"request": request, "esr": body["esr"]})
+        print(f"{account} {memo[:20]!r} -> {body['esr'][:40]}...")
+    return fixtures
+
+
+if __name__ == '__main__':
+    FIXTURE.parent.mkdir(exist_ok=True)
+    FIXTURE.write_text(json.dumps(record(sys.argv[1] if len(sys.argv) > 1 else ESR_URL),
+                                  ensure_ascii=False, indent=1), encoding='utf-8')
+    print(f"Wrote {FIXTURE}")
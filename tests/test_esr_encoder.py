@@ -0,0 +1,146 @@
+import base64
+import json
+import struct
+import unittest
+import zlib
+
+import esr_encoder
+from api import build_acknowledge
+from tests.record_esr_fixtures import FIXTURE
+
+
+class Reader:
+    """Just enough of the EOSIO binary format to read back what esr_encoder writes"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def uint8(self):
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def varuint32(self):
+        value, shift = 0, 0
+        while True:
+            byte = self.uint8()
+            value |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value
+
+    def uint64(self):
+        self.pos += 8
+        return struct.unpack("<Q", self.data[self.pos - 8:self.pos])[0]
+
+    def bytes(self):
+        size = self.varuint32()
+        self.pos += size
+        return self.data[self.pos - size:self.pos]
+
+
+def decode(uri):
+    """(header, payload) of an esr:// URI"""
+    encoded = uri[len("esr://"):]
+    data = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+    header, payload = data[0], data[1:]
+    if header & 1 << 7:
+        payload = zlib.decompress(payload, -15)
+    return header, payload
+
+
+def read_action(reader):
+    account, name = reader.uint64(), reader.uint64()
+    authorization = [(reader.uint64(), reader.uint64()) for _ in range(reader.varuint32())]
+    data = Reader(reader.bytes())
+    return {
+        "account": account,
+        "name": name,
+        "authorization": authorization,
+        "from": data.uint64(),
+        "to": data.uint64(),
+        "memo": data.bytes().decode("utf-8"),
+    }
+
+
+class EncodeNameTest(unittest.TestCase):
+
+    def test_known_values(self):
+        cases = (
+            ("", 0),
+            ("eosio", 6138663577826885632),
+            ("eosio.token", 6138663591592764928),
+            ("............1", 1),
+            ("............2", 2),
+        )
+        for name, value in cases:
+            with self.subTest(name=name):
+                self.assertEqual(esr_encoder.encode_name(name), value)
+
+    def test_invalid_names(self):
+        for name in ("aaaaaaaaaaaaz", "aaaaaaaaaaaak", "aaaaaaaaaaaaaa", "Felipe", "felipe_seeds", "seeds6",
+                     "name\n", None):
+            with self.subTest(name=name):
+                with self.assertRaises(ValueError):
+                    esr_encoder.encode_name(name)
+
+    def test_thirteenth_char_is_not_masked(self):
+        self.assertNotEqual(esr_encoder.encode_name("aaaaaaaaaaaaj"), esr_encoder.encode_name("aaaaaaaaaaaa"))
+
+
+class EncodeActionsTest(unittest.TestCase):
+
+    def assertRoundTrip(self, accounts, memo):
+        header, payload = decode(esr_encoder.encode_request(build_acknowledge(accounts, memo))["esr"])
+        self.assertEqual(header & 0x7f, esr_encoder.ESR_VERSION)
+
+        reader = Reader(payload)
+        self.assertEqual((reader.uint8(), reader.uint8()), (0, esr_encoder.ESR_CHAIN_ALIAS))
+        variant = reader.uint8()
+        if isinstance(accounts, str):
+            self.assertEqual(variant, 0)
+            actions = [read_action(reader)]
+        else:
+            self.assertEqual(variant, 1)
+            actions = [read_action(reader) for _ in range(reader.varuint32())]
+        self.assertEqual(reader.uint8(), esr_encoder.FLAG_BROADCAST)
+        self.assertEqual(reader.bytes(), b"")
+        self.assertEqual(reader.varuint32(), 0)
+        self.assertEqual(reader.pos, len(payload))
+
+        expected = [accounts] if isinstance(accounts, str) else accounts
+        self.assertEqual([action["to"] for action in actions], [esr_encoder.encode_name(to) for to in expected])
+        for action in actions:
+            self.assertEqual(action["account"], esr_encoder.encode_name("gratz.seeds"))
+            self.assertEqual(action["name"], esr_encoder.encode_name("acknowledge"))
+            self.assertEqual(action["authorization"], [(1, 2)])
+            self.assertEqual(action["from"], 1)
+            self.assertEqual(action["memo"], memo)
+
+    def test_round_trip(self):
+        cases = (
+            ("felipenseeds", ""),
+            ("felipenseeds", "Obrigado pela ajuda!"),
+            ("gratz.seeds", "acentuação, emoji 🙏 e <b>html</b>"),
+            ("a", "x" * 300),
+            (["felipenseeds", "maria1234511"], "Valeu, time"),
+        )
+        for accounts, memo in cases:
+            with self.subTest(accounts=accounts, memo=memo):
+                self.assertRoundTrip(accounts, memo)
+
+    def test_unknown_action(self):
+        request = build_acknowledge("felipenseeds")
+        request["actions"][0]["name"] = "transfer"
+        with self.assertRaises(ValueError):
+            esr_encoder.encode_request(request)
+
+
+@unittest.skipUnless(FIXTURE.exists(), "no recorded Hypha output, run python3 -m tests.record_esr_fixtures")
+class RemoteFixtureTest(unittest.TestCase):
+    """The local encoder must produce the exact URI the Hypha service returned"""
+
+    def test_same_as_remote(self):
+        for fixture in json.loads(FIXTURE.read_text(encoding='utf-8')):
+            with self.subTest(request=fixture["request"]):
+                self.assertEqual(esr_encoder.encode_request(fixture["request"])["esr"], fixture["esr"])
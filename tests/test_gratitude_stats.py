@@ -0,0 +1,114 @@
+import random
+import unittest
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+from peewee import SqliteDatabase, fn
+
+import gratitude_stats
+from db import GratitudeCounter, GratitudeTotal, GratitudeWindow, GratitudeWindowState
+from gratitude_stats import CHAT, GIVEN, RECEIVED, GratitudeStats, roll_windows, write_counters
+
+MODELS = [GratitudeCounter, GratitudeTotal, GratitudeWindow, GratitudeWindowState]
+TODAY = date(2026, 10, 18)
+
+
+class LockingSqliteDatabase(SqliteDatabase):
+    """SQLite has no row locks (it locks the whole database), accept and drop FOR UPDATE/SHARE"""
+    for_update = True
+
+    def execute_sql(self, sql, params=None, commit=None):
+        sql = sql.replace(' FOR UPDATE', '').replace(' FOR SHARE', '')
+        return super().execute_sql(sql, params)
+
+
+def event(day, sender, recipient, chat=-100):
+    return {"chat": chat, "sender": sender, "recipient": recipient,
+            "created_date": datetime.combine(day, datetime.min.time()),
+            "sender_name": f"sender{sender}", "recipient_name": f"recipient{recipient}"}
+
+
+class GratitudeWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = LockingSqliteDatabase(":memory:")
+        self.binding = self.db.bind_ctx(MODELS)
+        self.binding.__enter__()
+        self.db.create_tables(MODELS)
+        patcher = mock.patch.object(gratitude_stats, "db", self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stats = GratitudeStats(ttl=0, top_size=3, windows=(1, 7, 30))
+
+    def tearDown(self):
+        self.binding.__exit__(None, None, None)
+        self.db.close()
+
+    def expected(self, chat, days, today):
+        """The old scan over the daily counters"""
+        rows = (GratitudeCounter
+                .select(GratitudeCounter.role, GratitudeCounter.member, fn.SUM(GratitudeCounter.count))
+                .where((GratitudeCounter.chat == chat) & (GratitudeCounter.day > today - timedelta(days=days)))
+                .group_by(GratitudeCounter.role, GratitudeCounter.member)
+                .tuples())
+        return {(role, member): count for role, member, count in rows}
+
+    def window(self, chat, days):
+        rows = (GratitudeWindow
+                .select(GratitudeWindow.role, GratitudeWindow.member, GratitudeWindow.count)
+                .where((GratitudeWindow.chat == chat) & (GratitudeWindow.days == days))
+                .tuples())
+        return {(role, member): count for role, member, count in rows}
+
+    def test_windows_match_the_daily_counters_while_rolling(self):
+        rng = random.Random(7)
+        # History before the windows exist, filled from the counters on the first roll
+        write_counters([event(TODAY - timedelta(days=rng.randrange(60)), rng.randrange(5), rng.randrange(5))
+                        for _ in range(300)])
+        roll_windows((1, 7, 30), today=TODAY)
+
+        for offset in range(45):
+            today = TODAY + timedelta(days=offset)
+            write_counters([event(today, rng.randrange(5), rng.randrange(5), chat=rng.choice((-100, -200)))
+                            for _ in range(rng.randrange(10))])
+            # Rolls may also run late and catch up several days at once
+            if offset % 4 == 0:
+                roll_windows((1, 7, 30), today=today)
+                for chat in (-100, -200):
+                    for days in (1, 7, 30):
+                        with self.subTest(day=offset, chat=chat, days=days):
+                            self.assertEqual(self.window(chat, days), self.expected(chat, days, today))
+
+    def test_late_events_are_not_added_to_expired_windows(self):
+        roll_windows((7,), today=TODAY)
+        write_counters([event(TODAY - timedelta(days=10), 1, 2)])
+        self.assertEqual(self.window(-100, 7), {})
+        self.assertEqual(GratitudeTotal.select().count(), 3)
+
+    def test_top(self):
+        roll_windows((1, 7, 30), today=TODAY)
+        events = [event(TODAY, 1, 2)] * 3 + [event(TODAY, 2, 3)] * 2 + [event(TODAY, 3, 4), event(TODAY, 4, 5)]
+        events += [event(TODAY - timedelta(days=20), 5, 1)] * 5
+        write_counters(events)
+
+        week = self.stats._top(-100, 7)
+        self.assertEqual(week["given"][:2], [("sender1", 3), ("sender2", 2)])
+        self.assertEqual(week["given"][2][1], 1)
+        self.assertEqual(week["received"][:2], [("recipient2", 3), ("recipient3", 2)])
+        self.assertEqual(len(week["received"]), 3)
+        self.assertEqual(week["total"], 7)
+
+        self.assertEqual(self.stats._top(-100, 30)["given"][0], ("sender5", 5))
+        self.assertEqual(self.stats._top(-100, None)["total"], 12)
+        self.assertEqual(self.stats._top(-999, 7), {"given": [], "received": [], "total": 0})
+
+    def test_window_for_period(self):
+        self.assertEqual([self.stats.window(days) for days in (None, 1, 2, 7, 8, 30, 400)],
+                         [None, 1, 7, 7, 30, 30, 30])
+
+
+class RoleNamesTest(unittest.TestCase):
+
+    def test_roles_fit_the_column(self):
+        for role in (GIVEN, RECEIVED, CHAT):
+            self.assertLessEqual(len(role), GratitudeCounter.role.max_length)
@@ -0,0 +1,104 @@
+import unittest
+
+from aiogram.types import MessageEntity, User
+
+from gratz_parser import parse_gratz
+
+
+def utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def entity(text, kind, part, user_id=None):
+    """Entity over the first occurrence of part, offsets in UTF-16 units like Telegram sends them"""
+    user = User(id=user_id, is_bot=False, first_name=part) if user_id else None
+    return MessageEntity(type=kind, offset=utf16_len(text[:text.index(part)]), length=utf16_len(part), user=user)
+
+
+def message(text, *mentions, text_mentions=()):
+    """Entities a Telegram client would send: the command, the @mentions and (name, user_id) text mentions"""
+    entities = []
+    if text.startswith('/'):
+        entities.append(MessageEntity(type='bot_command', offset=0, length=len(text.split(' ', 1)[0])))
+    entities += [entity(text, 'mention', mention) for mention in mentions]
+    entities += [entity(text, 'text_mention', name, user_id) for name, user_id in text_mentions]
+    return text, entities
+
+
+# (case, (text, entities), command, [(user_id, name)], memo)
+CASES = (
+    ("mention",
+     message("/gratz @felipenseeds obrigado!", "@felipenseeds"),
+     "gratz", [(None, "felipenseeds")], "obrigado!"),
+    ("command with bot username",
+     message("/gratz@SeedsGratidaumBot @ana valeu", "@ana"),
+     "gratz", [(None, "ana")], "valeu"),
+    ("several recipients",
+     message("/gratz @ana @bob @carla gratidão pelo encontro", "@ana", "@bob", "@carla"),
+     "gratz", [(None, "ana"), (None, "bob"), (None, "carla")], "gratidão pelo encontro"),
+    ("duplicated recipients are dropped, case insensitive",
+     message("/gratz @ana @Ana @bob valeu", "@ana", "@Ana", "@bob"),
+     "gratz", [(None, "ana"), (None, "bob")], "valeu"),
+    ("mention without entity still starts with @",
+     message("/gratz @ana @x valeu", "@ana"),
+     "gratz", [(None, "ana"), (None, "x")], "valeu"),
+    ("mentions inside the memo are not recipients",
+     message("/gratz @ana valeu, @bob também ajudou", "@ana", "@bob"),
+     "gratz", [(None, "ana")], "valeu, @bob também ajudou"),
+    ("text mention",
+     message("/gratz Maria Clara valeu pela ajuda", text_mentions=[("Maria Clara", 1234)]),
+     "gratz", [(1234, "Maria Clara")], "valeu pela ajuda"),
+    ("text mention and mention",
+     message("/gratz @ana Maria Clara valeu", "@ana", text_mentions=[("Maria Clara", 1234)]),
+     "gratz", [(None, "ana"), (1234, "Maria Clara")], "valeu"),
+    ("text mention after some words",
+     message("/gratz muito obrigado Maria Clara pela ajuda", text_mentions=[("Maria Clara", 1234)]),
+     "gratz", [(1234, "Maria Clara")], "muito obrigado pela ajuda"),
+    ("text mention at the end",
+     message("/gratz valeu demais Maria Clara", text_mentions=[("Maria Clara", 1234)]),
+     "gratz", [(1234, "Maria Clara")], "valeu demais"),
+    ("mention after some words",
+     message("/gratz valeu @ana pela ajuda", "@ana"),
+     "gratz", [(None, "ana")], "valeu pela ajuda"),
+    ("emoji before a mention (UTF-16 offsets)",
+     message("/gratz 🌱🙏 @ana valeu", "@ana"),
+     "gratz", [(None, "ana")], "🌱🙏 valeu"),
+    ("emoji in the memo and the name",
+     message("/gratz 💚Zé💚 obrigado 🙏 @bob", "@bob", text_mentions=[("💚Zé💚", 99)]),
+     "gratz", [(99, "💚Zé💚")], "obrigado 🙏 @bob"),
+    ("name typed without @",
+     message("/ack joao muito obrigado"),
+     "ack", [(None, "joao")], "muito obrigado"),
+    ("no entities at all",
+     ("/ack joao muito obrigado", []),
+     "ack", [(None, "joao")], "muito obrigado"),
+    ("no recipient",
+     message("/gratz"),
+     "gratz", [], ""),
+    ("no recipient, only spaces",
+     message("/gratz    "),
+     "gratz", [], ""),
+    ("recipient without memo",
+     message("/gratz @ana", "@ana"),
+     "gratz", [(None, "ana")], ""),
+    ("empty text",
+     (None, None),
+     None, [], ""),
+)
+
+
+class ParseGratzTest(unittest.TestCase):
+
+    def test_cases(self):
+        for case, (text, entities), command, recipients, memo in CASES:
+            with self.subTest(case):
+                parsed = parse_gratz(text, entities)
+                self.assertEqual(parsed.command, command)
+                self.assertEqual([(r.user_id, r.name) for r in parsed.recipients], recipients)
+                self.assertEqual(parsed.memo, memo)
+
+    def test_recipient_offsets_are_utf16(self):
+        text, entities = message("/gratz 🌱 @ana valeu", "@ana")
+        recipient, = parse_gratz(text, entities).recipients
+        self.assertEqual((recipient.offset, recipient.length), (entities[1].offset, entities[1].length))
+        self.assertEqual(recipient.offset, utf16_len("/gratz 🌱 "))
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from peewee import SqliteDatabase
+
+import pg_storage
+import repository
+from db import FsmState
+from pg_storage import PostgresStorage
+
+
+class NoStateCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        # A file, every DB pool thread opens its own connection
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.db = SqliteDatabase(path)
+        self.binding = self.db.bind_ctx([FsmState])
+        self.binding.__enter__()
+        self.db.create_tables([FsmState])
+        patcher = mock.patch.object(repository, "db", self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.reads = 0
+        read = PostgresStorage._read
+
+        def counting_read(storage, chat, user):
+            self.reads += 1
+            return read(storage, chat, user)
+
+        patcher = mock.patch.object(PostgresStorage, "_read", counting_read)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = PostgresStorage()
+
+    def tearDown(self):
+        self.binding.__exit__(None, None, None)
+        self.db.close()
+
+    async def test_no_state_is_read_once(self):
+        for _ in range(3):
+            self.assertIsNone(await self.storage.get_state(chat=1, user=2))
+            self.assertEqual(await self.storage.get_data(chat=1, user=2), {})
+        self.assertEqual(self.reads, 1)
+
+    async def test_writes_forget_the_key(self):
+        self.assertIsNone(await self.storage.get_state(chat=1, user=2))
+        await self.storage.set_state(chat=1, user=2, state="Form:name")
+        self.assertEqual(await self.storage.get_state(chat=1, user=2), "Form:name")
+
+        await self.storage.update_data(chat=1, user=2, name="Maria")
+        self.assertEqual(await self.storage.get_data(chat=1, user=2), {"name": "Maria"})
+
+        await self.storage.reset_state(chat=1, user=2)
+        self.assertIsNone(await self.storage.get_state(chat=1, user=2))
+        reads = self.reads
+        self.assertIsNone(await self.storage.get_state(chat=1, user=2))
+        self.assertEqual(self.reads, reads)
+
+    async def test_read_overlapping_a_write_is_not_cached(self):
+        async def read_during_write(func, *args):
+            if func == self.storage._read:
+                await self.storage.set_state(chat=1, user=2, state="Form:name")
+                return None, {}
+            return func(*args)
+
+        with mock.patch.object(pg_storage, "run_db", read_during_write):
+            self.assertIsNone(await self.storage.get_state(chat=1, user=2))
+        self.assertEqual(await self.storage.get_state(chat=1, user=2), "Form:name")
+
+    async def test_ttl_zero_disables_the_cache(self):
+        storage = PostgresStorage(no_state_ttl=0)
+        await storage.get_state(chat=1, user=2)
+        await storage.get_state(chat=1, user=2)
+        self.assertEqual(self.reads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
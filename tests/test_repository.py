@@ -0,0 +1,43 @@
+import unittest
+from unittest import mock
+
+from peewee import OperationalError, SqliteDatabase
+
+import repository
+
+
+class RunDbTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.db = SqliteDatabase(":memory:")
+        patcher = mock.patch.object(repository, "db", self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_reconnects_on_the_pool_thread_after_a_dropped_connection(self):
+        connections = []
+
+        def query():
+            connections.append(self.db.connection())
+            if len(connections) == 1:
+                raise OperationalError("server closed the connection unexpectedly")
+            return self.db.execute_sql("SELECT 1").fetchone()[0]
+
+        self.assertEqual(await repository.run_db(query), 1)
+        self.assertEqual(len(connections), 2)
+        self.assertIsNot(connections[0], connections[1])
+
+    async def test_gives_up_after_one_retry(self):
+        calls = []
+
+        def query():
+            calls.append(1)
+            raise OperationalError("could not connect to server")
+
+        with self.assertRaises(OperationalError):
+            await repository.run_db(query)
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
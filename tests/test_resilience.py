@@ -0,0 +1,196 @@
+import asyncio
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from api import EsrClient, EsrUnavailable, build_acknowledge
+from resilience import CircuitBreaker, CircuitOpenError, ResilientCall
+
+ESR = "esr://gmNgZGBY1mTC_MoglIGBIFBgEIrQqjnycnAK"
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=self.clock)
+
+    def open(self):
+        for _ in range(2):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_opens_after_threshold(self):
+        self.open()
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.rejected, 1)
+
+    def test_single_probe_after_reset_timeout(self):
+        self.open()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        self.open()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_abandoned_probe_allows_a_new_one(self):
+        self.open()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.abandon()
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+    def test_lost_probe_expires(self):
+        self.open()
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow())
+
+
+class ResilientCallTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_cancelled_probe_does_not_stick_half_open(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        resilience = ResilientCall(attempts=1, attempt_timeout=5, deadline=5, breaker=breaker)
+
+        async def fail():
+            raise ValueError("down")
+
+        with self.assertRaises(ValueError):
+            await resilience.call(fail)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.sleep(60)
+
+        probe = asyncio.ensure_future(resilience.call(hang))
+        await started.wait()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        probe.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await probe
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        async def ok():
+            return "ok"
+
+        self.assertEqual(await resilience.call(ok), "ok")
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+class StandInEsr:
+    """Plays the Hypha /qr endpoint, each request takes the next behaviour from the script"""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.requests = 0
+
+    async def handler(self, request):
+        await request.json()
+        self.requests += 1
+        behaviour = self.script.pop(0) if len(self.script) > 1 else self.script[0]
+        if behaviour == "ok":
+            return web.json_response({"esr": ESR, "qr": "https://example.org/qr.png"})
+        if behaviour == "slow":
+            await asyncio.sleep(1)
+            return web.json_response({"esr": ESR, "qr": None})
+        if behaviour == "html":
+            return web.Response(text="<html>Bad gateway</html>", content_type="text/html")
+        if behaviour == "empty":
+            return web.json_response({"error": "no esr"})
+        return web.Response(status=500, text="boom")
+
+
+class EsrClientStandInTest(unittest.IsolatedAsyncioTestCase):
+
+    async def start(self, *script, attempts=3, breaker=None):
+        self.esr = StandInEsr(*script)
+        app = web.Application()
+        app.router.add_post("/qr", self.esr.handler)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.addAsyncCleanup(self.server.close)
+
+        client = EsrClient(url=str(self.server.make_url("/qr")), encoder="remote")
+        client.resilience = ResilientCall(attempts=attempts, attempt_timeout=0.3, deadline=2, backoff=0.01,
+                                          hedge_percentile=0, breaker=breaker,
+                                          retry_on=client.resilience.retry_on)
+        await client.start()
+        self.addAsyncCleanup(client.close)
+        return client
+
+    async def test_healthy(self):
+        client = await self.start("ok")
+        self.assertEqual((await client.get_qr("felipenseeds", "valeu"))["esr"], ESR)
+        self.assertEqual(self.esr.requests, 1)
+
+    async def test_retries_flaky_answers(self):
+        for behaviour in ("500", "html", "empty", "slow"):
+            with self.subTest(behaviour=behaviour):
+                client = await self.start(behaviour, "ok")
+                self.assertEqual((await client.get_qr("felipenseeds"))["esr"], ESR)
+                self.assertEqual(self.esr.requests, 2)
+                self.assertEqual(client.resilience.retries, 1)
+
+    async def test_unavailable_after_attempts(self):
+        client = await self.start("500", attempts=3)
+        with self.assertRaises(EsrUnavailable):
+            await client.get_qr("felipenseeds")
+        self.assertEqual(self.esr.requests, 3)
+
+    async def test_breaker_fails_fast(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        client = await self.start("500", attempts=1, breaker=breaker)
+        for _ in range(2):
+            with self.assertRaises(EsrUnavailable):
+                await client.get_qr("felipenseeds")
+        with self.assertRaises(EsrUnavailable) as raised:
+            await client.get_qr("felipenseeds")
+        self.assertIsInstance(raised.exception.__cause__, CircuitOpenError)
+        self.assertEqual(self.esr.requests, 2)
+
+    async def test_sends_one_action_per_recipient(self):
+        received = []
+
+        async def handler(request):
+            received.append(await request.json())
+            return web.json_response({"esr": ESR})
+
+        app = web.Application()
+        app.router.add_post("/qr", handler)
+        server = TestServer(app)
+        await server.start_server()
+        self.addAsyncCleanup(server.close)
+        client = await EsrClient(url=str(server.make_url("/qr")), encoder="remote").start()
+        self.addAsyncCleanup(client.close)
+
+        await client.get_qr(["felipenseeds", "maria1234511"], "valeu")
+        self.assertEqual(received, [build_acknowledge(["felipenseeds", "maria1234511"], "valeu")])
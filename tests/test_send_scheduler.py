@@ -0,0 +1,48 @@
+import unittest
+
+from aiogram.utils.exceptions import RetryAfter
+
+from send_scheduler import SendScheduler
+
+
+class SendSchedulerTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.scheduler = SendScheduler(bot=None, global_rate=1000, private_rate=1000, group_rate=1000,
+                                       chat_burst=10)
+
+    async def test_chat_buckets(self):
+        async def send(chat_id):
+            return chat_id
+
+        for chat_id in (1234, "1234", -1001234, "@seedsgratidaum"):
+            with self.subTest(chat_id=chat_id):
+                self.assertEqual(await self.scheduler.call(chat_id, send, chat_id), chat_id)
+        self.assertEqual(list(self.scheduler._chats), ["1234", "-1001234", "@seedsgratidaum"])
+        self.assertEqual(self.scheduler._chats["1234"].rate, self.scheduler.private_rate)
+        self.assertEqual(self.scheduler._chats["@seedsgratidaum"].rate, self.scheduler.group_rate)
+
+    async def test_retry_after_slows_every_chat(self):
+        calls = []
+
+        async def flood(chat_id):
+            calls.append(chat_id)
+            if len(calls) == 1:
+                raise RetryAfter(0.05)
+            return chat_id
+
+        self.assertEqual(await self.scheduler.call(1, flood, 1), 1)
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(self.scheduler.retried, 1)
+
+    async def test_retry_after_penalizes_the_global_bucket(self):
+        self.scheduler.max_retries = 0
+
+        async def flood(chat_id):
+            raise RetryAfter(5)
+
+        with self.assertRaises(RetryAfter):
+            await self.scheduler.call(1, flood, 1)
+        # Another chat has a fresh bucket of its own but still waits for the global one
+        self.assertGreater(self.scheduler._global.reserve(), 4)
+        self.assertEqual(self.scheduler._chat_bucket(2).reserve(), 0)
@@ -0,0 +1,32 @@
+import unittest
+from pathlib import Path
+
+from aiogram.contrib.middlewares.i18n import I18nMiddleware
+
+from templates import LookupTranslations, TemplateCatalog
+
+LOCALES_DIR = Path(__file__).resolve().parent.parent / 'locales'
+HELLO = 'Olá {name}'
+
+
+class TemplateCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.i18n = I18nMiddleware('mybot', LOCALES_DIR)
+        self.templates = TemplateCatalog(self.i18n)
+
+    def test_shares_the_middleware_catalogs(self):
+        self.assertIs(self.templates.translations, self.i18n.locales)
+        self.assertEqual(set(self.templates.locales), set(self.i18n.locales))
+
+    def test_reload_drops_the_old_templates(self):
+        self.i18n.locales = {'en': LookupTranslations({HELLO: 'Hello {name}'})}
+        self.assertEqual(self.templates.render(HELLO, 'en', name='Maria'), 'Hello Maria')
+
+        self.i18n.locales = {'en': LookupTranslations({HELLO: 'Hi {name}'})}
+        self.assertEqual(self.templates.render(HELLO, 'en', name='Maria'), 'Hi Maria')
+        self.assertEqual(self.templates.render(HELLO, 'pt', name='Maria'), 'Olá Maria')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import unittest
+from unittest import mock
+
+from aiogram import types
+
+# webhook_server builds its Bot at import, the token only has to be well formed
+os.environ.setdefault("API_TOKEN", "123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA")
+
+import webhook_server  # noqa: E402
+
+
+def gratz(*names, memo="valeu"):
+    text = "/gratz " + " ".join(f"@{name}" for name in names) + " " + memo
+    entities = [{"type": "bot_command", "offset": 0, "length": len("/gratz")}]
+    for name in names:
+        entities.append({"type": "mention", "offset": text.index(f"@{name}"), "length": len(name) + 1})
+    return types.Message.to_object({
+        "message_id": 1, "date": 0, "text": text, "entities": entities,
+        "chat": {"id": -100, "type": "supergroup", "title": "Seeds"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Maria"},
+    })
+
+
+class AckRecipientLimitTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.reply = mock.AsyncMock()
+        self.resolve = mock.AsyncMock(return_value=([], []))
+        for patcher in (mock.patch.object(webhook_server.outbox, "reply", self.reply),
+                        mock.patch.object(webhook_server.outbox, "send_message", mock.AsyncMock()),
+                        mock.patch.object(webhook_server, "resolve_recipients", self.resolve),
+                        mock.patch.object(webhook_server, "GRATZ_MAX_RECIPIENTS", 3)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_over_the_limit_is_rejected_with_the_limit(self):
+        await webhook_server.ack(gratz("ana", "bob", "carla", "davi"))
+
+        self.resolve.assert_not_called()
+        self.reply.assert_awaited_once()
+        text = self.reply.await_args.args[1]
+        self.assertIn("no máximo 3 pessoas", text)
+        self.assertIn("mencionou 4", text)
+
+    async def test_at_the_limit_everyone_is_looked_up(self):
+        await webhook_server.ack(gratz("ana", "bob", "carla"))
+
+        self.reply.assert_not_called()
+        self.resolve.assert_awaited_once()
+        self.assertEqual(len(self.resolve.await_args.args[0]), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
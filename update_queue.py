@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import typing
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiohttp import web
+
+from dedup import UPDATE_DEDUP_KEY
+
+log = logging.getLogger("update_queue")
+
+UPDATE_QUEUE_KEY = 'UPDATE_QUEUE'
+
+# 0 keeps aiogram's default: the update is processed inside the webhook request
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 0))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_QUEUE_RETRY_AFTER = int(os.getenv("UPDATE_QUEUE_RETRY_AFTER", 5))
+
+
+def chat_key(update: types.Update):
+    """Updates with the same key are always processed in order, by the same worker"""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.my_chat_member:
+        return update.my_chat_member.chat.id
+    if update.chat_member:
+        return update.chat_member.chat.id
+    if update.channel_post:
+        return update.channel_post.chat.id
+    return update.update_id
+
+
+class UpdateQueue:
+    """
+    Bounded queue of updates drained by a pool of async workers.
+
+    Every worker owns its own queue and updates are routed by chat_key, so
+    updates from one chat never run concurrently or out of order while
+    different chats are processed in parallel.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, workers=UPDATE_WORKERS or 4, maxsize=UPDATE_QUEUE_SIZE,
+                 retry_after=UPDATE_QUEUE_RETRY_AFTER):
+        self.dispatcher = dispatcher
+        self.workers = workers
+        self.retry_after = retry_after
+        per_worker = max(1, maxsize // workers)
+        self._queues = [asyncio.Queue(maxsize=per_worker) for _ in range(workers)]
+        self._tasks: typing.List[asyncio.Task] = []
+        self.enqueued = 0
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def offer(self, update: types.Update) -> bool:
+        """Enqueue without waiting, False when that chat's worker is full"""
+        queue = self._queues[hash(chat_key(update)) % self.workers]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            log.warning("Update queue full, rejected update %s", update.update_id)
+            return False
+        self.enqueued += 1
+        return True
+
+    async def put(self, update: types.Update):
+        """Enqueue, waiting while that chat's worker is full (backpressure for the polling worker)"""
+        await self._queues[hash(chat_key(update)) % self.workers].put(update)
+        self.enqueued += 1
+
+    async def join(self):
+        """Wait until every update enqueued so far was processed"""
+        await asyncio.gather(*(queue.join() for queue in self._queues))
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def stop(self, drain=True):
+        if drain:
+            await self.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, queue: asyncio.Queue):
+        Dispatcher.set_current(self.dispatcher)
+        Bot.set_current(self.dispatcher.bot)
+        while True:
+            update = await queue.get()
+            try:
+                await self.dispatcher.updates_handler.notify(update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                log.exception("Failed to process update %s => Error %s", update.update_id, e)
+            finally:
+                queue.task_done()
+
+    def depth(self):
+        return sum(queue.qsize() for queue in self._queues)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "depth": self.depth(),
+            "max_worker_depth": max(queue.qsize() for queue in self._queues),
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+        }
+
+
+class QueuedWebhookRequestHandler(WebhookRequestHandler):
+    """
+    Webhook view that only validates and enqueues the update.
+
+    Telegram gets its 200 right away; when the queue is full we answer 429 so
+    Telegram keeps the update and delivers it again later. Duplicated updates
+    are answered 200 and dropped before reaching the queue.
+    """
+
+    async def post(self):
+        self.validate_ip()
+
+        dispatcher = self.get_dispatcher()
+        try:
+            update = await self.parse_update(dispatcher.bot)
+        except (ValueError, TypeError) as e:
+            log.warning("Invalid update payload => Error %s", e)
+            return web.Response(status=400, text='invalid update')
+
+        dedup = self.request.app.get(UPDATE_DEDUP_KEY)
+        if dedup is not None and not await dedup.claim(update.update_id):
+            return web.Response(text='ok')
+
+        queue: UpdateQueue = self.request.app[UPDATE_QUEUE_KEY]
+        if not queue.offer(update):
+            if dedup is not None:
+                # Telegram will deliver it again, that copy must not be suppressed
+                await dedup.release(update.update_id)
+            return web.Response(status=429, text='busy', headers={'Retry-After': str(queue.retry_after)})
+
+        return web.Response(text='ok')
@@ -1,34 +1,52 @@
-import traceback
-from datetime import datetime
+import time
+
+IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import io
 import logging
 from pathlib import Path
-from typing import Optional
 
 import aiogram.utils.markdown as md
-from aiogram.dispatcher.filters import Text, ChatTypeFilter
+from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.webhook import DEFAULT_ROUTE_NAME
 from aiogram.utils.deep_linking import get_start_link
 
 from aiogram import Bot, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
-from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher import Dispatcher, FSMContext
 from aiogram.dispatcher.filters.state import StatesGroup, State
-from aiogram.types import ParseMode, MessageEntityType, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, \
-    MessageEntity, ChatType
-from aiogram.utils.executor import set_webhook
+from aiogram.types import ParseMode, CallbackQuery, ChatType
+from aiogram.utils.exceptions import InvalidQueryID, MessageNotModified
+from aiogram.utils.executor import Executor
 import os
 
 from aiohttp import web
-from playhouse.shortcuts import model_to_dict
 
-from api import api_get
-from db import db, User
-from helpers import strip_html
+from api import EsrClient, EsrUnavailable
+from db import init_db
+from dedup import UpdateDeduplicator, DedupWebhookRequestHandler, UPDATE_DEDUP_KEY
+from esr_cache import EsrCache, esr_key
+import esr_encoder
+from helpers import StartupReport
 from i18n_user_middleware import I18nUserMiddleware
-from migrate import start_migration
-
-logging.basicConfig(level=logging.INFO, force=True)
+import migrate
+from gratitude_stats import GratitudeStats
+from ledger import GratitudeLedger
+import metrics
+from log_config import setup_logging, LogContextMiddleware, ctx_handler
+from pg_storage import PostgresStorage
+from update_queue import UpdateQueue, QueuedWebhookRequestHandler, UPDATE_QUEUE_KEY, UPDATE_WORKERS
+import repository
+from gratz_parser import parse_gratz
+from repository import users
+from sanitizer import sanitize_memo, escape_html
+from send_scheduler import SendScheduler
+from templates import TemplateCatalog, N_
+from markups import LANGUAGE_KEYBOARD, REMOVE_KEYBOARD
+
+setup_logging()
 
 NGROK_LOCAL = 'https://1620-170-84-182-230.ngrok.io'
 APP_VERSION = 1.4
@@ -37,7 +55,11 @@ API_TOKEN = os.getenv("API_TOKEN")
 CHAT_ID_FATHER = os.getenv("CHAT_ID_FATHER", None)
 
 if not CHAT_ID_FATHER:
-    logging.warning(f"Chat ID FATHER is not present, check your CHAT_ID_FATHER env variables")
+    logging.warning("Chat ID FATHER is not present, check your CHAT_ID_FATHER env variables")
+
+# Another Bot API server, e.g. a local telegram-bot-api or a fake one for benchmarks
+TELEGRAM_API_SERVER = (TelegramAPIServer.from_base(os.getenv("TELEGRAM_API_SERVER"))
+                       if os.getenv("TELEGRAM_API_SERVER") else TELEGRAM_PRODUCTION)
 
 # webhook settings
 WEBHOOK_HOST = os.getenv("WEBHOOK_HOST") if os.getenv("WEBHOOK_HOST") else NGROK_LOCAL
@@ -48,17 +70,36 @@ WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
 WEBAPP_HOST = os.getenv("WEBAPP_HOST") if os.getenv("WEBAPP_HOST") else '0.0.0.0'  # or ip
 WEBAPP_PORT = os.getenv("PORT", 3001)
 
-logging.info(f"Port to listen: {WEBAPP_PORT}")
+logging.info("Port to listen: %s", WEBAPP_PORT)
+
+# Migrations normally run in the release phase (python3 migrate.py),
+# at startup we only pay for the "already at head" check
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "1") == "1"
+# A single /gratz acknowledges at most this many people, keeps the transaction small enough to sign
+GRATZ_MAX_RECIPIENTS = int(os.getenv("GRATZ_MAX_RECIPIENTS", 10))
 
-# Start migration
-start_migration()
+startup_report = StartupReport()
 
-bot = Bot(token=API_TOKEN)
+bot = Bot(token=API_TOKEN, server=TELEGRAM_API_SERVER)
 
-# For example use simple MemoryStorage for Dispatcher.
-storage = MemoryStorage()
+esr_client = EsrClient()
+esr_cache = EsrCache()
+ledger = GratitudeLedger()
+gratitude_stats = GratitudeStats()
+outbox = SendScheduler(bot)
+
+# FSM states live in Postgres so every dyno/worker shares them and they survive restarts,
+# FSM_STORAGE=memory is handy for local development
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+storage = MemoryStorage() if FSM_STORAGE == "memory" else PostgresStorage()
 dp = Dispatcher(bot, storage=storage)
-dp.middleware.setup(LoggingMiddleware())
+dp.middleware.setup(LogContextMiddleware())
+dp.middleware.setup(metrics.MetricsMiddleware())
+logging.getLogger().addHandler(metrics.ErrorCountingHandler())
+
+# With UPDATE_WORKERS > 0 the webhook answers at once and workers process the updates
+update_queue = UpdateQueue(dp, workers=UPDATE_WORKERS) if UPDATE_WORKERS else None
+update_dedup = UpdateDeduplicator()
 
 I18N_DOMAIN = 'mybot'
 
@@ -72,6 +113,38 @@ dp.middleware.setup(i18n)
 # Alias for gettext method
 _ = i18n.gettext
 
+# Long messages are split once per locale and rendered with a join, see templates.py
+templates = TemplateCatalog(i18n)
+
+MSG_FOOTER = N_('<b>OBS:</b> Nunca compartilhe sua senha com ninguém, e a guarde em lugar seguro.')
+MSG_HELP = N_('Precisa de ajuda, <b>{full_name}</b>?\n'
+              'Segue uma lista de comandos que você pode usar:\n\n'
+              '🥰 /gratz @nomedapessoa Mensagem de gratidaum\n'
+              '       📜 Envia gratidaum para a pessoa selecionada.\n'
+              '🤔 /ajuda\n'
+              '       📜 Esse menu de ajuda\n\n'
+              '<a href="{start_link_setup}" >🤖 Inicie a configuração CLICANDO AQUI 🤖</a>\n\n'
+              '{msg_footer}')
+MSG_WELCOME = N_('Olá Prazer em te conhecer,<b>{full_name}</b>\n\n'
+                 'Eu sou um <b>robô</b> que está aqui pra te ajudar a configurar sua conta\n\n'
+                 'Eu preciso saber o <b>username</b> da sua conta SEEDS para que você possa receber <b>Gratidaum</b>.\n\n'
+                 'Envie "cancel" (sem aspas) a qualquer momento para cancelar\n\n'
+                 '{msg_footer}')
+MSG_WELCOME_BACK = N_('Olá novamente,<b>{full_name}</b>\n\n'
+                      'Você já tem uma conta do SEEDS cadastrado com o username: <b>{username}</b>.\n\n'
+                      'Envie "<b>cancel</b>" (sem aspas) a qualquer momento para cancelar\n\n'
+                      '{msg_footer}')
+MSG_CONFIRM_LINK = N_("Confirme o envio da Gratidaum")
+MSG_SIGN = N_("🥳 Sua Gratidaum está quase chegando para {to} 🎉\n\n"
+              "Você precisa confirmar a transação.\n"
+              "Você tem 2 opções:\n\n"
+              'Clique no link abaixo para assinar com Seeds Wallet/Anchor\n'
+              '{link_confirm_transaction}\n\n'
+              'Ou\n\n'
+              "Escaneie o QR Code abaixo para assinar a transação\n")
+
+templates.preload(MSG_HELP, MSG_WELCOME, MSG_WELCOME_BACK, MSG_SIGN)
+
 
 # States
 class Form(StatesGroup):
@@ -83,59 +156,104 @@ class Form(StatesGroup):
 # Helper funcs
 async def send_msg_father(msg):
     if CHAT_ID_FATHER:
-        await bot.send_message(chat_id=CHAT_ID_FATHER, text=msg)
+        await outbox.send_message(CHAT_ID_FATHER, msg)
     else:
         logging.info("CHAT_ID_FATHER env not defined in send_msg_father(). Do nothihg")
 
 
 def build_qr_msg(json_eosio, to_who=None):
+    locale = i18n.ctx_locale.get()
     link_wallet = f'https://eosio.to/{json_eosio["esr"][6:]}'
-    link_confirm_transaction = md.hlink(_("Confirme o envio da Gratidaum"), link_wallet)
+    link_confirm_transaction = md.hlink(templates.text(MSG_CONFIRM_LINK, locale), link_wallet)
     # qr_code = md.hlink('QRCode', json_eosio['qr'])
     # qr_code = md.hlink('QRCode', json_eosio['qr'])
     # qr_code = md.hide_link(json_eosio['qr'])
 
-    to = to_who if to_who else _('a pessoa')
-    msg_sign = _("🥳 Sua Gratidaum está quase chegando para {to} 🎉\n\n"
-                 "Você precisa confirmar a transação.\n"
-                 "Você tem 2 opções:\n\n"
-                 'Clique no link abaixo para assinar com Seeds Wallet/Anchor\n'
-                 '{link_confirm_transaction}\n\n'
-                 'Ou\n\n'
-                 "Escaneie o QR Code abaixo para assinar a transação\n").format(
-        to=to,
-        link_confirm_transaction=link_confirm_transaction)
-
-    qr_code = md.text(md.text("QRCODE", md.hide_link(json_eosio['qr'])), sep="\n")
-    logging.info(f"qr_code: {qr_code}")
-    return msg_sign, qr_code
-
-
-def get_user_id(message):
-    msg_entity = None
-    for msgEntity in message.entities:
-        if msgEntity.type == MessageEntityType.TEXT_MENTION or msgEntity.type == MessageEntityType.MENTION and msgEntity.user:
-            msg_entity = msgEntity
-            break
-    return msg_entity
-
-
-def db_close():
-    db.close()
-
-
-async def i18n_HELP(full_name, locale=None):
-    start_link_setup = await get_start_link('setup')
-    msg_footer = _('<b>OBS:</b> Nunca compartilhe sua senha com ninguém, e a guarde em lugar seguro.')
-    return _('Precisa de ajuda, <b>{full_name}</b>?\n'
-             'Segue uma lista de comandos que você pode usar:\n\n'
-             '🥰 /gratz @nomedapessoa Mensagem de gratidaum\n'
-             '       📜 Envia gratidaum para a pessoa selecionada.\n'
-             '🤔 /ajuda\n'
-             '       📜 Esse menu de ajuda\n\n' +
-             '<a href="{start_link_setup}" >🤖 Inicie a configuração CLICANDO AQUI 🤖</a>\n\n'
-             '{msg_footer}',
-             locale=locale).format(full_name=full_name, start_link_setup=start_link_setup, msg_footer=msg_footer)
+    to = escape_html(to_who) if to_who else _('a pessoa')
+    msg_sign = templates.render(MSG_SIGN, locale, to=to, link_confirm_transaction=link_confirm_transaction)
+
+    # Locally encoded requests have no hosted image, the QR is sent as a photo instead
+    qr_code = None
+    if json_eosio.get('qr'):
+        qr_code = md.text(md.text("QRCODE", md.hide_link(json_eosio['qr'])), sep="\n")
+    logging.debug("qr_code: %s", qr_code)
+    return msg_sign, qr_code, json_eosio["esr"]
+
+
+async def sign_request_messages(account, memo, to_who):
+    locale = i18n.ctx_locale.get()
+    messages = esr_cache.get_messages(account, memo, locale, to_who)
+    if messages is None:
+        json_eosio = await esr_cache.get_qr(esr_client, account=account, memo=memo)
+        messages = build_qr_msg(json_eosio, to_who)
+        esr_cache.set_messages(account, memo, locale, to_who, messages)
+    return messages
+
+
+async def resolve_recipients(recipients):
+    """
+    Look every recipient up with a single query
+
+    :return: (found, missing), found is a list of (name, User) without repeated
+        accounts, missing the names nobody registered
+    """
+    rows = await users.get_many([r.user_id for r in recipients if r.user_id], [r.name for r in recipients])
+    by_id = {row.user_id: row for row in rows if row.user_id}
+    by_name = {}
+    for row in rows:
+        if row.name:
+            by_name.setdefault(row.name.lower(), row)
+
+    found, missing, accounts = [], [], set()
+    for recipient in recipients:
+        user = by_id.get(str(recipient.user_id)) if recipient.user_id else None
+        if user is None:
+            user = by_name.get(recipient.name.lower())
+        if user is None:
+            missing.append(recipient.name)
+        elif user.username not in accounts:
+            accounts.add(user.username)
+            found.append((recipient.name, user))
+    return found, missing
+
+
+async def send_qr_photo(chat_id, esr):
+    """Render the QR locally once, afterwards reuse Telegram's file_id"""
+    file_id = esr_cache.get_photo(esr)
+    if file_id:
+        return await outbox.send_photo(chat_id, file_id, caption="QRCODE")
+
+    png = await asyncio.get_running_loop().run_in_executor(None, esr_encoder.qr_png, esr)
+    sent = await outbox.send_photo(chat_id, types.InputFile(io.BytesIO(png), filename="qrcode.png"),
+                                   caption="QRCODE")
+    esr_cache.set_photo(esr, sent.photo[-1].file_id)
+    return sent
+
+
+# Filled once by load_bot_identity() at startup, so deep links need no getMe round-trip
+setup_link = None
+
+# Help template per locale with the setup link already bound
+_help_texts = {}
+
+
+async def load_bot_identity():
+    global setup_link
+    me = await bot.me
+    setup_link = await get_start_link('setup')
+    _help_texts.clear()
+    logging.info("Bot identity: @%s setup_link=%s", me.username, setup_link)
+
+
+def i18n_HELP(full_name, locale=None):
+    locale = locale if locale else i18n.ctx_locale.get()
+    template = _help_texts.get(locale)
+    if template is None:
+        # Only full_name changes between users, the link and the footer are bound once
+        template = templates.get(MSG_HELP, locale).bind(start_link_setup=setup_link,
+                                                        msg_footer=templates.text(MSG_FOOTER, locale))
+        _help_texts[locale] = template
+    return template.render(full_name=full_name)
 
 
 # END - Helper funcs
@@ -148,47 +266,38 @@ async def i18n_HELP(full_name, locale=None):
 async def query_language_callback_handler(query: CallbackQuery):
     locale = query.data
     # always answer callback queries, even if you have nothing to say
+    i18n.ctx_locale.set(locale)
+    logging.debug("query_language_callback_handler: %s", query.data)
     try:
-        i18n.ctx_locale.set(locale)
-        logging.info(f"query_language_callback_handler: {query.data}")
         await query.answer(_('Idioma Português selecionado.'))
-    except Exception as e:
-        logging.error(traceback.format_exc())
-        logging.error(e)
+    except InvalidQueryID as e:
+        # Answered too late, the locale is still saved below
+        logging.info("Callback query not answered => Error %s", e)
 
     user_id = query.from_user.id
-    logging.info(f"User id: {query.from_user.id}")
+    logging.info("User id: %s", query.from_user.id)
     if user_id:
-        has_user = User.get_or_none(user_id=query.from_user.id)
-        if not has_user:
-            logging.info(f"Creating from user id: {query.from_user.id}")
-            has_user = User.create(
-                user_id=query.from_user.id,
-                name=f"{query.from_user.full_name}",
-                username=f"{query.from_user.username}",
-                created_date=datetime.now(),
-                updated_date=datetime.now(),
-            )
-            logging.info(f"has_user in except: {has_user}")
+        has_user = await users.set_locale(user_id=query.from_user.id,
+                                          name=f"{query.from_user.full_name}",
+                                          username=f"{query.from_user.username}",
+                                          locale=locale)
+        i18n.remember_locale(user_id, locale)
 
         if has_user:
-            logging.info(f"Changed Locale to: {i18n.ctx_locale.get()}")
-            has_user.locale = locale
-            has_user.save()
-            # logging.info(f"Changed Locale to")
-            text = await i18n_HELP(query.from_user.full_name, locale)
+            logging.info("Changed Locale to: %s", i18n.ctx_locale.get())
+            # logging.info("Changed Locale to")
+            text = i18n_HELP(query.from_user.full_name, locale)
             try:
-                await bot.edit_message_text(chat_id=query.message.chat.id,
-                                            message_id=query.message.message_id,
-                                            text=text,
-                                            reply_markup=build_language_keyboard(),
-                                            parse_mode=ParseMode.HTML)
-            except Exception as e:
-                logging.error(traceback.format_exc())
-                logging.error(e)
+                await outbox.edit_message_text(chat_id=query.message.chat.id,
+                                               message_id=query.message.message_id,
+                                               text=text,
+                                               reply_markup=LANGUAGE_KEYBOARD,
+                                               parse_mode=ParseMode.HTML)
+            except MessageNotModified:
+                logging.debug("Help message already in locale %s", locale)
             # await start(query.message)
         else:
-            logging.info(f"User not found: {query.from_user.id}")
+            logging.info("User not found: %s", query.from_user.id)
     else:
         logging.info("user_id no present in query")
 
@@ -198,29 +307,22 @@ async def query_language_callback_handler(query: CallbackQuery):
 
 @dp.message_handler(commands=['help', 'ajuda'])
 async def help_handler(message: types.Message):
-    try:
-        locale = i18n.ctx_locale.get()
-        logging.warning(f"Help locale:{locale}")
-        text_help = await i18n_HELP(full_name=message.from_user.full_name, locale=locale)
-
-        keyboard_markup = build_language_keyboard()
-
-        await bot.send_message(
-            message.chat.id,
-            md.text(text_help, sep='\n'),
-            parse_mode=ParseMode.HTML,
-            reply_markup=keyboard_markup
-        )
-
-    except Exception as e:
-        db_close()
-        logging.error(traceback.format_exc())
-        logging.error(e)
+    locale = i18n.ctx_locale.get()
+    logging.debug("Help locale:%s", locale)
+    text_help = i18n_HELP(full_name=message.from_user.full_name, locale=locale)
+
+    await outbox.send_message(
+        message.chat.id,
+        text_help,
+        parse_mode=ParseMode.HTML,
+        reply_markup=LANGUAGE_KEYBOARD
+    )
 
 
 @dp.my_chat_member_handler()
 async def some_handler(my_chat_member: types.ChatMemberUpdated):
-    logging.info(f"Chat member update: {my_chat_member}")
+    logging.info("Chat member update in chat %s: %s -> %s", my_chat_member.chat.id,
+                 my_chat_member.old_chat_member.status, my_chat_member.new_chat_member.status)
 
     user = my_chat_member.new_chat_member.user
     status = my_chat_member.new_chat_member.status
@@ -229,7 +331,7 @@ async def some_handler(my_chat_member: types.ChatMemberUpdated):
             msg = f"'{my_chat_member.from_user.full_name}' adicionou o Bot no grupo '{my_chat_member.chat.title}'"
             logging.info(msg)
             await send_msg_father(msg)
-            # logging.info(f"Não me é permitido ficar aqui. Saindo do grupo")
+            # logging.info("Não me é permitido ficar aqui. Saindo do grupo")
             # await my_chat_member.chat.leave()
         elif status == "left":
             msg = f"'{my_chat_member.from_user.full_name}' removeu o Bot do grupo '{my_chat_member.chat.title}'"
@@ -239,107 +341,56 @@ async def some_handler(my_chat_member: types.ChatMemberUpdated):
 
 @dp.message_handler(commands=['admin'])
 async def admin(message: types.Message):
-    try:
-        logging.info(f"admin: {message}")
-    except Exception as e:
-        logging.error(traceback.format_exc())
-        logging.error(f"error: {e}")
-
-
-def build_language_keyboard():
-    keyboard_markup = InlineKeyboardMarkup(row_width=3)
-    # default row_width is 3, so here we can omit it actually
-    # kept for clearness
-
-    text_and_data = (
-        ('🇧🇷 Português 🇧🇷', 'pt'),
-        ('🇺🇸 English 🇺🇸', 'en'),
-        ('🇪🇸 Español 🇪🇸', 'es'),
-    )
-    # in real life for the callback_data the callback data factory should be used
-    # here the raw string is used for the simplicity
-    row_btns = (InlineKeyboardButton(text, callback_data=data) for text, data in text_and_data)
-    # CallbackData("lang","locale","action")
-    keyboard_markup.row(*row_btns)
-    # keyboard_markup.add(
-    #     # url buttons have no callback data
-    #     types.InlineKeyboardButton('aiogram source', url='https://github.com/aiogram/aiogram'),
-    # )
-    return keyboard_markup
-    # await message.reply("Hi!\nDo you love aiogram?", )
+    logging.info("admin requested by user %s", message.from_user.id)
+    logging.info("locale cache: %s", i18n.user_locales.stats())
+    logging.info("send scheduler: %s", outbox.stats())
 
 
 @dp.message_handler(commands=['start', 'borala', 'bora', 'começar'],
                     chat_type=[ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL])
 async def start_redirect_help(message: types.Message):
-    logging.warning(f"Msg in group or channel. Calling Help {message}")
+    logging.info("Start in %s %s, calling help", message.chat.type, message.chat.id)
     await help_handler(message)
 
 
 @dp.message_handler(commands=['start', 'borala', 'bora', 'começar'], chat_type=[ChatType.PRIVATE])
 async def start(message: types.Message):
-    try:
-        logging.info(f"{message.chat.type}")
-        logging.warning("Start")
-        user = None
-        # await Form.name.set()
-        await Form.username.set()
-        # await Form.language.set()
-        try:
-            if message.from_user.id:
-                logging.info(f"start::Looking for user_id: {message.from_user.id}")
-                user = User.get(User.user_id == message.from_user.id)
-            elif message.from_user.username:
-                logging.info(f"start::Looking for username: {message.from_user.username}")
-                user = User.get(User.name == message.from_user.username)
-            else:
-                logging.info(f"start::Looking for full_name: {message.from_user.full_name}")
-                user = User.get(User.name == message.from_user.full_name)
-        except Exception as e:
-            logging.info(f"User not found=>just ignore")
-            logging.error(traceback.format_exc())
-            logging.error(e)
+    logging.info("Start from user %s", message.from_user.id)
+    user = None
+    # await Form.name.set()
+    await Form.username.set()
+    # await Form.language.set()
+    if message.from_user.id:
+        logging.debug("start::Looking for user_id: %s", message.from_user.id)
+        user = await users.get_by_telegram_id(message.from_user.id)
+    elif message.from_user.username:
+        logging.debug("start::Looking for username: %s", message.from_user.username)
+        user = await users.get_by_name(message.from_user.username)
+    else:
+        logging.debug("start::Looking for full_name: %s", message.from_user.full_name)
+        user = await users.get_by_name(message.from_user.full_name)
 
-        msg_footer = _('<b>OBS:</b> Nunca compartilhe sua senha com ninguém, e a guarde em lugar seguro.')
+    locale = i18n.ctx_locale.get()
+    msg_footer = templates.text(MSG_FOOTER, locale)
 
-        if user is None:
-            logging.info(f"start::user not found show welcome {message.from_user}")
-            await bot.send_message(
-                message.chat.id,
-                md.text(
-                    _('Olá Prazer em te conhecer,<b>{full_name}</b>\n\n'
-                      'Eu sou um <b>robô</b> que está aqui pra te ajudar a configurar sua conta\n\n'
-                      'Eu preciso saber o <b>username</b> da sua conta SEEDS para que você possa receber <b>Gratidaum</b>.\n\n'
-                      'Envie "cancel" (sem aspas) a qualquer momento para cancelar\n\n'
-                      '{msg_footer}')
-                        .format(full_name=message.from_user.full_name, msg_footer=msg_footer),
-                    sep='\n',
-                ),
-                parse_mode=ParseMode.HTML,
-            )
-            await message.reply(_("Qual seu username do SEEDS?"))
-        else:
-            username = user.username
-
-            await bot.send_message(
-                message.chat.id,
-                md.text(
-                    _('Olá novamente,<b>{full_name}</b>\n\n'
-                      'Você já tem uma conta do SEEDS cadastrado com o username: <b>{username}</b>.\n\n'
-                      'Envie "<b>cancel</b>" (sem aspas) a qualquer momento para cancelar\n\n'
-                      '{msg_footer}')
-                        .format(full_name=message.from_user.full_name,
-                                username=username, msg_footer=msg_footer),
-                    sep='\n',
-                ),
-                parse_mode=ParseMode.HTML,
-            )
-            await message.reply(_("Qual o novo username do SEEDS?"))
+    if user is None:
+        logging.info("start::user %s not found show welcome", message.from_user.id)
+        await outbox.send_message(
+            message.chat.id,
+            templates.render(MSG_WELCOME, locale, full_name=message.from_user.full_name, msg_footer=msg_footer),
+            parse_mode=ParseMode.HTML,
+        )
+        await outbox.reply(message, _("Qual seu username do SEEDS?"))
+    else:
+        username = user.username
 
-    except Exception as e:
-        db_close()
-        logging.error(traceback.format_exc())
-        logging.error(e)
+        await outbox.send_message(
+            message.chat.id,
+            templates.render(MSG_WELCOME_BACK, locale, full_name=message.from_user.full_name,
+                             username=username, msg_footer=msg_footer),
+            parse_mode=ParseMode.HTML,
+        )
+        await outbox.reply(message, _("Qual o novo username do SEEDS?"))
 
 
 # You can use state '*' if you need to handle all states
@@ -357,7 +408,7 @@ async def cancel_handler(message: types.Message, state: FSMContext):
     # Cancel state and inform user about it
     await state.finish()
     # And remove keyboard (just in case)
-    await message.reply(_('Cancelado.'), reply_markup=types.ReplyKeyboardRemove())
+    await outbox.reply(message, _('Cancelado.'), reply_markup=REMOVE_KEYBOARD)
 
 
 # Check username.
@@ -367,187 +418,259 @@ async def process_username_invalid(message: types.Message):
     If username is invalid
     """
 
-    return await message.reply(
+    return await outbox.reply(
+        message,
         _("Oh Não! Isso não é um username válido. Vamos tentar novamente.\n"
           "Qual seu username do SEEDS? (Ex: felipenseeds)"))
 
 
 @dp.message_handler(lambda message: message.text.isalnum(), state=Form.username)
 async def process_username(message: types.Message, state: FSMContext):
-    try:
-        # Update state and data
-        async with state.proxy() as data:
-            data['username'] = message.text
-            data['name'] = message.from_user.full_name
+    # Update state and data
+    async with state.proxy() as data:
+        data['username'] = message.text
+        data['name'] = message.from_user.full_name
 
-            name = message.from_user.full_name if not message.from_user.username else message.from_user.username
-            try:
-                with db.transaction():
-                    has_user = User.get_or_none(user_id=message.from_user.id)
-                    if has_user:
-                        has_user.username = message.text
-                        has_user.name = name
-                        # has_user.user_id = message.from_user.id
-                        has_user.updated_date = datetime.now()
-                        has_user.save()
-                        logging.info(f" user updated by user_id {has_user}")
-                    else:
-                        has_user = User.get_or_none(name=name)
-                        if has_user:
-                            has_user.username = message.text
-                            has_user.user_id = message.from_user.id
-                            has_user.updated_date = datetime.now()
-                            has_user.save()
-                            logging.info(f" user updated by name {model_to_dict(has_user)}")
-                        else:
-                            user_id = (User.insert(
-                                name=name,
-                                username=message.text,
-                                user_id=message.from_user.id,
-                                created_date=datetime.now(),
-                                updated_date=datetime.now())
-                                       .execute())
-                            logging.info(f"UserID upserted: {user_id}")
-
-                # And send message
-                await bot.send_message(
-                    message.chat.id,
-                    md.text(
-                        _('Muito bem <b>{full_name}</b>!\n'
-                          'Seu username do SEEDS: <b>{username}</b>\n'
-                          'Agora você já pode enviar e receber Gratidaum!')
-                            .format(full_name=message.from_user.full_name, username=data['username']),
-                        sep='\n',
-                    ),
-                    reply_markup=types.ReplyKeyboardRemove(),
-                    parse_mode=ParseMode.HTML,
-                )
-            except ValueError:
-                db_close()
-                logging.info(f"Deu ruim no upsert")
-                await bot.send_message(
-                    message.chat.id,
-                    md.text(
-                        _('Ops. Algo deu errado'),
-                        sep='\n',
-                    ),
-                    reply_markup=types.ReplyKeyboardRemove(),
-                    parse_mode=ParseMode.HTML,
-                )
-
-        # Finish conversation
-        await state.finish()
-
-    except Exception as e:
-        db_close()
-        logging.error(e)
-        logging.error(traceback.format_exc())
+        name = message.from_user.full_name if not message.from_user.username else message.from_user.username
+        try:
+            await users.upsert_username(user_id=message.from_user.id, name=name, username=message.text)
+            i18n.forget_locale(message.from_user.id)
+
+            # And send message
+            await outbox.send_message(
+                message.chat.id,
+                md.text(
+                    _('Muito bem <b>{full_name}</b>!\n'
+                      'Seu username do SEEDS: <b>{username}</b>\n'
+                      'Agora você já pode enviar e receber Gratidaum!')
+                        .format(full_name=message.from_user.full_name, username=data['username']),
+                    sep='\n',
+                ),
+                reply_markup=REMOVE_KEYBOARD,
+                parse_mode=ParseMode.HTML,
+            )
+        except ValueError:
+            logging.info("Deu ruim no upsert")
+            await outbox.send_message(
+                message.chat.id,
+                md.text(
+                    _('Ops. Algo deu errado'),
+                    sep='\n',
+                ),
+                reply_markup=REMOVE_KEYBOARD,
+                parse_mode=ParseMode.HTML,
+            )
+
+    # Finish conversation
+    await state.finish()
 
 
 @dp.message_handler(commands=['ack', 'gratz'])
 async def ack(message: types.Message):
-    try:
-        # check if user is bot message.from_user.is_bot
-        if message.from_user.is_bot:
-            logging.info("Bot talking...ignore")
+    # check if user is bot message.from_user.is_bot
+    if message.from_user.is_bot:
+        logging.info("Bot talking...ignore")
+        return
+
+        # extract params
+    command = parse_gratz(message.text, message.entities)
+
+    if command.recipients or command.memo:
+
+        logging.debug("Memo before sanitize: %s", command.memo)
+        memo = sanitize_memo(command.memo)
+        if not memo:
+            await outbox.reply(message, _("Use /ack @nome Escreva seu Agradecimento"))
             return
+            # memo = ''
 
-            # extract params
-        first = message.get_args()
+        logging.debug("Memo after sanitize: %s", memo)
 
-        if first:
+        if not command.recipients:
+            await outbox.reply(message, _("Use /ack @nome Escreva seu Agradecimento"))
+            return
 
-            who = None
-            memo = None
-            user_id = None
+        if len(command.recipients) > GRATZ_MAX_RECIPIENTS:
+            # Rejected as a whole, dropping the extra ones would look like everyone was thanked
+            await outbox.reply(message, _("Uma Gratidaum pode ser enviada para no máximo {limit} pessoas, "
+                                          "você mencionou {count}. Divida em mais de um /gratz.")
+                               .format(limit=GRATZ_MAX_RECIPIENTS, count=len(command.recipients)))
+            return
 
-            msg_entity: Optional[MessageEntity] = get_user_id(message)
-            if msg_entity:
-                user_id = msg_entity.user.id
-                if message.text:
-                    who = message.text[msg_entity.offset: msg_entity.offset + msg_entity.length]
-                    memo = message.text[msg_entity.offset + msg_entity.length:]
-            else:
-                args = first.split(" ", 1)
-                who = args[0] if len(args) > 0 else None
-                memo = args[1] if len(args) > 1 else None
+        found, missing = await resolve_recipients(command.recipients)
+
+        if found:
+            who = ", ".join(name for name, _user in found)
+            accounts = [user.username for _name, user in found]
+            # msg = f"{user_mention} envia Gratidaum para {who}{f' - {memo}' if memo else ''}"
+
+            msg = _("{user_mention} envia Gratidaum para <b>{who}</b> {memo}").format(
+                user_mention=message.from_user.get_mention(as_html=True),
+                who=escape_html(who),
+                memo=escape_html(memo))
+            logging.info("Gratidaum from user %s to %s recipients", message.from_user.id, len(found))
+
+            async def send_sign_request():
+                # One transaction acknowledging everyone, one signing message and QR
+                try:
+                    msg_sign, qr_code, esr = await sign_request_messages(accounts, memo, who)
+                except EsrUnavailable as e:
+                    logging.error("ESR unavailable => Error %s", e)
+                    await outbox.send_message(
+                        message.from_user.id,
+                        _("😔 Não consegui gerar a transação da sua Gratidaum agora, "
+                          "o serviço de assinatura está fora do ar. Tente novamente em alguns minutos."))
+                    return
+
+                await outbox.send_message(message.from_user.id, msg_sign, parse_mode=ParseMode.HTML)
+                # Only a Gratidaum whose signing request reached the sender counts in /top and /stats
+                esr_id = esr_key(accounts, memo)
+                for _name, user in found:
+                    ledger.record(message.from_user.id, user.pk_id, message.chat.id, memo, esr_id,
+                                  sender_name=message.from_user.full_name, recipient_name=user.name)
+                if qr_code:
+                    await outbox.send_message(message.from_user.id, qr_code, parse_mode=ParseMode.HTML)
+                else:
+                    await send_qr_photo(message.from_user.id, esr)
+
+            # Reply to chat origin the Gratidaum sent while the private messages go out
+            await asyncio.gather(
+                outbox.send_message(message.chat.id, msg, parse_mode=ParseMode.HTML),
+                send_sign_request(),
+            )
 
-            logging.debug(f"Memo before strip_html: {memo}")
-            if memo:
-                memo = strip_html(memo)
-            else:
-                await message.reply(_("Use /ack @nome Escreva seu Agradecimento"))
-                return
-                # memo = ''
+        if missing:
+            who = ", ".join(missing)
+            link_setup_html = md.hlink(_('🤖 Peça que a pessoa inicie a configuração CLICANDO AQUI 🤖'),
+                                       setup_link)
+            await outbox.send_message(message.chat.id, md.text(
+                _("Não encontramos essa pessoa de nome <b>{who}</b> "
+                  "talvez seja necessário essa pessoa se registrar.\n\n"
+                  "{link_setup_html}").format(who=escape_html(who), link_setup_html=link_setup_html),
+                sep='\n',
+            ), parse_mode=ParseMode.HTML)
+            logging.info("Esses usuarios não foram encontrados no DB %s", who)
+    else:
+        await outbox.send_message(message.chat.id, _("Use /ack @nome agradecimento"))
 
-            logging.info(f"Memo after strip_html: {memo}")
 
-            if who is None:
-                await message.reply(_("Use /ack @nome Escreva seu Agradecimento"))
-            else:
-                if who[0] == '@':
-                    who = who[1:]
-
-            has_user = None
-            if user_id:
-                has_user = User.get_or_none(user_id=user_id)
-
-            if not has_user:
-                has_user = User.get_or_none(name=who)
-
-            if has_user:
-                # msg = f"{user_mention} envia Gratidaum para {who}{f' - {memo}' if memo else ''}"
-
-                msg = _("{user_mention} envia Gratidaum para <b>{who}</b> {memo}").format(
-                    user_mention=message.from_user.get_mention(as_html=True),
-                    who=who,
-                    memo=memo)
-                # Reply to chat origin the Gratidaum sent
-                await bot.send_message(message.chat.id, msg, parse_mode=ParseMode.HTML)
-                logging.info(msg)
-                # CallAPI Hypha and create QRCODE and Link to sign transaction
-                json_eosio = await api_get(account=f"{has_user.username}", memo=memo)
-                logging.info(json_eosio)
-                msg_sign, qr_code = build_qr_msg(json_eosio, who)
-                logging.info(msg_sign)
-
-                await bot.send_message(message.from_user.id, msg_sign, parse_mode=ParseMode.HTML)
-                await bot.send_message(message.from_user.id, qr_code, parse_mode=ParseMode.HTML)
+def format_ranking(ranking):
+    return "\n".join(f"{position}. {escape_html(name or '?')} — {count}"
+                     for position, (name, count) in enumerate(ranking, 1))
 
-            else:
-                start_link_setup = await get_start_link('setup')
-                link_setup_html = md.hlink(_('🤖 Peça que a pessoa inicie a configuração CLICANDO AQUI 🤖'),
-                                           start_link_setup)
-                await bot.send_message(message.chat.id, md.text(
-                    _("Não encontramos essa pessoa de nome <b>{who}</b> "
-                      "talvez seja necessário essa pessoa se registrar.\n\n"
-                      "{link_setup_html}").format(who=who, link_setup_html=link_setup_html),
-                    sep='\n',
-                ), parse_mode=ParseMode.HTML)
-                logging.info(f"Esse usuario não foi encontrado no DB {who}")
-        else:
-            await bot.send_message(message.chat.id, _("Use /ack @nome agradecimento"))
 
-    except Exception as e:
-        db_close()
-        logging.error(e)
-        logging.error(traceback.format_exc())
+def parse_top_period(args):
+    """/top [days|all], a week when omitted, rounded up to one of the rolling windows"""
+    args = (args or '').strip().lower()
+    if args in ('all', 'tudo', 'todos', 'sempre'):
+        return None
+    if args.isdigit():
+        return gratitude_stats.window(max(1, int(args)))
+    return gratitude_stats.window(7)
+
+
+@dp.message_handler(commands=['top', 'ranking'])
+async def top_handler(message: types.Message):
+    days = parse_top_period(message.get_args())
+    top = await gratitude_stats.top(message.chat.id, days)
+
+    if not top["total"]:
+        await outbox.reply(message, _("Nenhuma Gratidaum registrada aqui ainda. Use /gratz @nome agradecimento"))
+        return
+
+    title = (_("🏆 <b>Gratidaum nos últimos {days} dias</b>").format(days=days) if days
+             else _("🏆 <b>Gratidaum desde o início</b>"))
+    await outbox.send_message(message.chat.id, md.text(
+        title,
+        "",
+        _("<b>Quem mais recebeu</b>"),
+        format_ranking(top["received"]),
+        "",
+        _("<b>Quem mais enviou</b>"),
+        format_ranking(top["given"]),
+        "",
+        _("Total: {total}").format(total=top["total"]),
+        sep='\n',
+    ), parse_mode=ParseMode.HTML)
+
+
+@dp.message_handler(commands=['stats', 'estatisticas'])
+async def stats_handler(message: types.Message):
+    user = await users.get_by_telegram_id(message.from_user.id)
+    # In private chats show every group, in a group only that group
+    chat = None if message.chat.type == ChatType.PRIVATE else message.chat.id
+    stats = await gratitude_stats.member(message.from_user.id, user.pk_id if user else None, chat)
+
+    await outbox.reply(message, md.text(
+        _("📊 <b>Suas Gratidaum</b>"),
+        _("Enviadas: {given} ({given_week} nos últimos 7 dias)").format(**stats),
+        _("Recebidas: {received} ({received_week} nos últimos 7 dias)").format(**stats),
+        sep='\n',
+    ), parse_mode=ParseMode.HTML)
 
 
 @dp.message_handler()
 async def not_found(message: types.Message):
-    logging.warning(f"Not found command: [{message.text}]")
+    logging.debug("Not found command: [%s]", message.text)
     if message.chat.type != 'private':
-        logging.warning(f"Awnsered in group or channel just ignore msg: [{message.text}]")
+        logging.debug("Awnsered in group or channel just ignore msg: [%s]", message.text)
         return
     # Regular request
-    await bot.send_message(message.chat.id, _("Ops! Eu não conheço esse comando: [{command}].")
+    await outbox.send_message(message.chat.id, _("Ops! Eu não conheço esse comando: [{command}].")
                            .format(command=message.text))
 
 
+async def start_services():
+    """Everything the webhook and the polling worker need before the first update"""
+    with startup_report.phase("database"):
+        init_db(create_tables=False)
+    with startup_report.phase("migration"):
+        if not migrate.is_at_head():
+            if MIGRATE_ON_STARTUP:
+                migrate.run_migrations()
+            else:
+                logging.warning("Database is behind migration head=%s, run python3 migrate.py", migrate.head())
+    if isinstance(storage, PostgresStorage):
+        storage.start_cleanup()
+    ledger.start()
+    gratitude_stats.start()
+    update_dedup.start_cleanup()
+    with startup_report.phase("identity"):
+        await load_bot_identity()
+    await esr_client.start()
+
+
+async def stop_services():
+    """Counterpart of start_services, once no more updates are being processed"""
+    await esr_client.close()
+
+    await update_dedup.close()
+    logging.info("update dedup: %s", update_dedup.stats())
+
+    await gratitude_stats.close()
+
+    # Events still buffered go to the database before the pool is shut down
+    await ledger.close()
+    logging.info("gratitude ledger: %s", ledger.stats())
+
+    # Close DB connection (if used)
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+
+    repository.shutdown()
+
+    logging.info("locale cache: %s", i18n.user_locales.stats())
+    logging.info("send scheduler: %s", outbox.stats())
+
+
 async def on_startup_handler(_dpp):
     logging.warning('Startup..')
-    await bot.set_webhook(WEBHOOK_URL)
+    await start_services()
+    if update_queue:
+        update_queue.start()
+    with startup_report.phase("webhook"):
+        await bot.set_webhook(WEBHOOK_URL)
+    startup_report.log()
     # insert code here to run it after start
 
 
@@ -555,22 +678,51 @@ async def on_shutdown_handler(_dpp):
     logging.warning('Shutting down..')
 
     # insert code here to run it before shutdown
+    if update_queue:
+        await update_queue.stop(drain=True)
+        logging.info("update queue: %s", update_queue.stats())
 
     # Remove webhook (not acceptable in some cases)
     await bot.delete_webhook()
 
-    # Close DB connection (if used)
-    await dp.storage.close()
-    await dp.storage.wait_closed()
+    await stop_services()
 
     logging.warning('Bye!')
 
 
+@dp.errors_handler()
+async def handler_errors_handler(_update, exception):
+    """Every exception a handler raises ends here, so handlers do not catch their own"""
+    metrics.record_error(exception)
+    logging.error("Handler %s failed => Error %s", ctx_handler.get() or "none", exception, exc_info=exception)
+    # Handled: the update is acknowledged, Telegram must not redeliver it
+    return True
+
+
+async def metrics_path_handler(_request):
+    return web.Response(text=metrics.REGISTRY.render(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
 async def root_path_handler(_request):
     # name = request.match_info.get('name', "Anonymous")
     return web.Response(text=f'Eu sou o Seeds Gratidaum Bot e tenho {APP_VERSION} anos de idade.')
 
 
+async def status_path_handler(_request):
+    return web.json_response({
+        "update_queue": update_queue.stats() if update_queue else None,
+        "update_dedup": update_dedup.stats(),
+        "locale_cache": i18n.user_locales.stats(),
+        "fsm_no_state_cache": storage.stats() if isinstance(storage, PostgresStorage) else None,
+        "send_scheduler": outbox.stats(),
+        "esr_cache": esr_cache.stats(),
+        "gratitude_ledger": ledger.stats(),
+        "gratitude_stats": gratitude_stats.stats(),
+        "esr_client": esr_client.stats(),
+    })
+
+
 def start_webhook(dispatcher, webhook_path, *, loop=None, skip_updates=None,
                   on_startup=None, on_shutdown=None, check_ip=False, retry_after=None, route_name=DEFAULT_ROUTE_NAME,
                   **kwargs):
@@ -589,26 +741,34 @@ def start_webhook(dispatcher, webhook_path, *, loop=None, skip_updates=None,
     :param kwargs:
     :return:
     """
-    executor = set_webhook(dispatcher=dispatcher,
-                           webhook_path=webhook_path,
-                           loop=loop,
-                           skip_updates=skip_updates,
-                           on_startup=on_startup,
-                           on_shutdown=on_shutdown,
-                           check_ip=check_ip,
-                           retry_after=retry_after,
-                           route_name=route_name)
+    executor = Executor(dispatcher, skip_updates=skip_updates, check_ip=check_ip, retry_after=retry_after,
+                        loop=loop)
+    if on_startup is not None:
+        executor.on_startup(on_startup)
+    if on_shutdown is not None:
+        executor.on_shutdown(on_shutdown)
+
+    if update_queue:
+        executor.set_webhook(webhook_path, request_handler=QueuedWebhookRequestHandler, route_name=route_name)
+        executor.web_app[UPDATE_QUEUE_KEY] = update_queue
+    else:
+        executor.set_webhook(webhook_path, request_handler=DedupWebhookRequestHandler, route_name=route_name)
+    executor.web_app[UPDATE_DEDUP_KEY] = update_dedup
 
     # executor.web_app.router.add_route(method="GET",
     #                                   path="/",
     #                                   handler=root_path_handler,
     #                                   name="root_handler")
 
-    executor.web_app.add_routes([web.get("/", root_path_handler)])
+    executor.web_app.add_routes([web.get("/", root_path_handler),
+                                 web.get("/status", status_path_handler),
+                                 web.get("/metrics", metrics_path_handler)])
 
     executor.run_app(**kwargs)
 
 
+startup_report.add("import", time.perf_counter() - IMPORT_STARTED)
+
 if __name__ == '__main__':
     start_webhook(
         dispatcher=dp,